@@ -1,25 +1,39 @@
 import os
+import re
+import itertools
+import time
+import atexit
+import threading
+import queue
+import click
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-import csv
+import psycopg2.pool
+from psycopg2 import sql as pgsql
 import hashlib
+import hmac
 import uuid
 import json
 import zipfile
 import shutil
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from functools import wraps
+from datetime import datetime, date
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps, lru_cache
 from urllib.parse import quote
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, jsonify, session, Response, g, has_app_context
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import inch
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
-from PIL import Image
+from reportlab.platypus import Table, TableStyle
+from PIL import Image, ImageOps
 from user_agents import parse as parse_user_agent
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 
@@ -27,6 +41,16 @@ if not os.environ.get('SESSION_SECRET'):
     raise RuntimeError("SESSION_SECRET environment variable must be set for security. Please add it to Replit Secrets.")
 app.secret_key = os.environ.get('SESSION_SECRET')
 
+# Photo uploads are capped so Werkzeug rejects oversized bodies before spooling
+# them to disk; restore raises its own limit since a backup carries every photo.
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+BACKUP_MAX_UPLOAD = int(os.environ.get('BACKUP_MAX_UPLOAD_MB', 512)) * 1024 * 1024
+
+# File responses (cached PDFs, backups, photos) already go out through
+# wsgi.file_wrapper, which gunicorn serves with sendfile(). Behind Apache or
+# lighttpd, USE_X_SENDFILE=1 hands them to the front-end server instead.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
 UPLOAD_FOLDER = 'uploads'
 PDF_FOLDER = 'pdfs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -34,10 +58,22 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PDF_FOLDER, exist_ok=True)
+os.makedirs(os.path.join(PDF_FOLDER, 'cache'), exist_ok=True)
 os.makedirs('static/logo', exist_ok=True)
 os.makedirs('backups', exist_ok=True)
 BACKUP_FOLDER = 'backups'
 
+MONTHS = ('', 'January', 'February', 'March', 'April', 'May', 'June',
+          'July', 'August', 'September', 'October', 'November', 'December')
+
+PDF_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def run_in_background(fn, *args, executor=PDF_EXECUTOR):
+    def log_failure(future):
+        if future.exception():
+            app.logger.error('Background task %s failed', fn.__name__, exc_info=future.exception())
+    executor.submit(fn, *args).add_done_callback(log_failure)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -47,221 +83,457 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+PDF_TOKEN_SECRET = os.environ.get('SESSION_SECRET', 'default')
+
+@lru_cache(maxsize=4096)
 def generate_pdf_token(admission_number):
-    secret = os.environ.get('SESSION_SECRET', 'default')
-    data = f"{admission_number}-{secret}"
+    data = f"{admission_number}-{PDF_TOKEN_SECRET}"
     return hashlib.sha256(data.encode()).hexdigest()[:16]
 
 def verify_pdf_token(admission_number, token):
     expected_token = generate_pdf_token(admission_number)
-    return token == expected_token
+    return hmac.compare_digest(token.encode(), expected_token.encode())
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+PHOTO_MAX_SIZE = (400, 400)
+PHOTO_THUMB_SIZE = (128, 128)
+THUMB_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbs')
+
+def _photo_rgb(img):
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    return img.convert('RGB')
+
+def save_photo(file, admission_number):
+    filename = secure_filename(f"{admission_number}_{os.path.splitext(file.filename)[0]}.jpg")
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    
+    img = _photo_rgb(Image.open(file.stream))
+    img.thumbnail(PHOTO_MAX_SIZE, Image.LANCZOS)
+    img.save(filepath, 'JPEG', quality=82, optimize=True, progressive=True)
+    save_thumbnail(img, filename)
+    return filepath
+
+# The student list shows photos at 50px, so it loads a small JPEG thumbnail
+# kept under uploads/thumbs instead of the full photo.
+def thumbnail_name(filename):
+    return f"{os.path.splitext(filename)[0]}.jpg"
+
+def save_thumbnail(img, filename):
+    os.makedirs(THUMB_FOLDER, exist_ok=True)
+    thumb = img.copy()
+    thumb.thumbnail(PHOTO_THUMB_SIZE, Image.LANCZOS)
+    thumb_path = os.path.join(THUMB_FOLDER, thumbnail_name(filename))
+    tmp_path = f"{thumb_path}.{uuid.uuid4().hex}.tmp"
+    thumb.save(tmp_path, 'JPEG', quality=80, optimize=True)
+    os.replace(tmp_path, thumb_path)
+
+# Statements run through execute_prepared() are PREPAREd once per connection.
+# Neon's PgBouncer endpoint (-pooler hosts) runs in transaction mode, where a
+# server-side prepared statement may not exist on the next transaction's
+# backend, so they are only used on direct connections.
+USE_PREPARED_STATEMENTS = (os.environ.get('DB_PREPARED_STATEMENTS', '1') == '1'
+                           and '-pooler' not in (DATABASE_URL or ''))
+
+# init_db() bumps the generation after changing the schema; each pooled
+# connection then DEALLOCATEs its statements before it next uses one.
+_prepared_generation = 0
+
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.prepared_generation = _prepared_generation
+
+# %s placeholders become $1, $2, ... for PREPARE and %% becomes a literal %, so
+# statements are written exactly as they would be for cursor.execute().
+_PLACEHOLDER = re.compile(r'%([s%])')
+
+def _numbered_placeholders(sql):
+    numbers = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda m: f'${next(numbers)}' if m.group(1) == 's' else '%', sql)
+
+def execute_prepared(cursor, name, sql, params):
+    if not USE_PREPARED_STATEMENTS:
+        return cursor.execute(sql, params)
+    conn = cursor.connection
+    if conn.prepared_generation != _prepared_generation:
+        cursor.execute('DEALLOCATE ALL')
+        conn.prepared.clear()
+        conn.prepared_generation = _prepared_generation
+    if name not in conn.prepared:
+        cursor.execute(pgsql.SQL('PREPARE {} AS ').format(pgsql.Identifier(name)).as_string(conn)
+                       + _numbered_placeholders(sql))
+        conn.prepared.add(name)
+    statement = pgsql.SQL('EXECUTE {}').format(pgsql.Identifier(name))
+    if params:
+        statement += pgsql.SQL(' ({})').format(pgsql.SQL(', ').join(pgsql.Placeholder() * len(params)))
+    cursor.execute(statement, params)
+
+# Prepared statements name their columns: a SELECT * plan keeps the column list
+# it was prepared with, so it would go stale if the table gained a column.
+STUDENT_COLUMNS = ('id', 'admission_number', 'photo_path', 'name', 'father_name', 'mother_name',
+                   'dob', 'gender', 'class', 'board', 'medium', 'school_name', 'address', 'mobile1', 'mobile2',
+                   'fee_per_month', 'discount', 'admission_date', 'other_details', 'created_at')
+SELECT_STUDENT = f"SELECT {', '.join(STUDENT_COLUMNS)} FROM students"
+
+# Each gunicorn worker has its own pool; DB_POOL_MAX should cover the worker's
+# threads plus the background PDF and session-activity threads.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+# Shown in pg_stat_activity so the app's connections can be told apart.
+DB_APPLICATION_NAME = os.environ.get('DB_APPLICATION_NAME', 'sansa-learn')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, dsn=DATABASE_URL,
+                                                             connection_factory=PreparingConnection,
+                                                             application_name=DB_APPLICATION_NAME)
+                atexit.register(_pool.closeall)
+    return _pool
+
+# Neon suspends idle computes and drops their connections, so a pooled
+# connection that has been idle for a while is pinged before it is reused.
+POOL_PING_AFTER = 30
+_conn_last_used = {}
+
+def _checkout_connection():
+    for _ in range(3):
+        conn = get_pool().getconn()
+        last_used = _conn_last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < POOL_PING_AFTER:
+            return conn
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return conn
+        except psycopg2.Error:
+            _conn_last_used.pop(id(conn), None)
+            get_pool().putconn(conn, close=True)
+    return get_pool().getconn()
+
+def _release_connection(conn, broken=False):
+    if broken:
+        _conn_last_used.pop(id(conn), None)
+        get_pool().putconn(conn, close=True)
+    else:
+        _conn_last_used[id(conn)] = time.monotonic()
+        get_pool().putconn(conn)
+
+# Inside a request (or CLI command) every get_db() block shares one pooled
+# connection kept on flask.g and handed back in teardown. Background threads
+# have no app context and check a connection out per block instead.
+@contextmanager
 def get_db():
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+    if not has_app_context():
+        conn = _checkout_connection()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            _release_connection(conn, broken)
+        return
+    
+    if 'db' not in g:
+        g.db = _checkout_connection()
+    conn = g.db
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        g.pop('db', None)
+        _release_connection(conn, broken=True)
+        raise
+    except Exception:
+        if conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+        raise
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _release_connection(conn)
 
 def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
+    global _prepared_generation
+    with get_db() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS students (
-            id SERIAL PRIMARY KEY,
-            admission_number TEXT UNIQUE NOT NULL,
-            photo_path TEXT,
-            name TEXT NOT NULL,
-            father_name TEXT NOT NULL,
-            mother_name TEXT,
-            dob TEXT,
-            gender TEXT,
-            class TEXT,
-            board TEXT,
-            medium TEXT,
-            school_name TEXT,
-            address TEXT,
-            mobile1 TEXT,
-            mobile2 TEXT,
-            fee_per_month REAL,
-            discount REAL DEFAULT 0,
-            admission_date TEXT,
-            other_details TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS students (
+                id SERIAL PRIMARY KEY,
+                admission_number TEXT UNIQUE NOT NULL,
+                photo_path TEXT,
+                name TEXT NOT NULL,
+                father_name TEXT NOT NULL,
+                mother_name TEXT,
+                dob TEXT,
+                gender TEXT,
+                class TEXT,
+                board TEXT,
+                medium TEXT,
+                school_name TEXT,
+                address TEXT,
+                mobile1 TEXT,
+                mobile2 TEXT,
+                fee_per_month REAL,
+                discount REAL DEFAULT 0,
+                admission_date TEXT,
+                other_details TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS fees (
-            id SERIAL PRIMARY KEY,
-            student_id INTEGER NOT NULL,
-            month INTEGER NOT NULL,
-            year INTEGER NOT NULL,
-            fee_amount REAL NOT NULL,
-            is_paid INTEGER DEFAULT 0,
-            payment_date TEXT,
-            payment_mode TEXT,
-            remarks TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
-            UNIQUE(student_id, month, year)
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fees (
+                id SERIAL PRIMARY KEY,
+                student_id INTEGER NOT NULL,
+                month INTEGER NOT NULL,
+                year INTEGER NOT NULL,
+                fee_amount REAL NOT NULL,
+                is_paid INTEGER DEFAULT 0,
+                payment_date TEXT,
+                payment_mode TEXT,
+                remarks TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+                UNIQUE(student_id, month, year)
+            )
+        ''')
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS institute_info (
-            id INTEGER PRIMARY KEY,
-            logo_path TEXT,
-            address TEXT,
-            contact TEXT,
-            signature_path TEXT
-        )
-    ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS institute_info (
+                id INTEGER PRIMARY KEY,
+                logo_path TEXT,
+                address TEXT,
+                contact TEXT,
+                signature_path TEXT
+            )
+        ''')
+    
+        cursor.execute('SELECT COUNT(*) FROM institute_info')
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('''
+                INSERT INTO institute_info (id, address, contact) 
+                VALUES (1, 'Chandmari Road Kankarbagh gali no. 06 ke thik saamne', '9296820840, 9153021229')
+            ''')
     
-    cursor.execute('SELECT COUNT(*) FROM institute_info')
-    if cursor.fetchone()[0] == 0:
         cursor.execute('''
-            INSERT INTO institute_info (id, address, contact) 
-            VALUES (1, 'Chandmari Road Kankarbagh gali no. 06 ke thik saamne', '9296820840, 9153021229')
+            CREATE TABLE IF NOT EXISTS manager_sessions (
+                id SERIAL PRIMARY KEY,
+                session_id TEXT UNIQUE NOT NULL,
+                ip_address TEXT,
+                user_agent TEXT,
+                device_name TEXT,
+                os TEXT,
+                browser TEXT,
+                is_active INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
         ''')
     
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS manager_sessions (
-            id SERIAL PRIMARY KEY,
-            session_id TEXT UNIQUE NOT NULL,
-            ip_address TEXT,
-            user_agent TEXT,
-            device_name TEXT,
-            os TEXT,
-            browser TEXT,
-            is_active INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_fees_month_year_paid
+            ON fees (year, month, is_paid) INCLUDE (fee_amount)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_fees_year_student
+            ON fees (year, student_id) INCLUDE (month, is_paid)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_fees_student_unpaid
+            ON fees (student_id, year, month) INCLUDE (fee_amount) WHERE is_paid = 0
+        ''')
+    
+        # Serves both the 30-day cleanup of revoked sessions and the
+        # "recent inactive sessions" list on the sessions page.
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_sessions_inactive_last_seen
+            ON manager_sessions (last_seen_at) WHERE is_active = 0
+        ''')
+    
+        # Statement-level triggers bump a per-table counter whenever rows in
+        # students or fees change, so rendered pages can be cached by version.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM changed) THEN
+                    UPDATE table_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        for table in ('students', 'fees'):
+            cursor.execute('INSERT INTO table_versions (table_name) VALUES (%s) ON CONFLICT DO NOTHING', (table,))
+            for op, transition in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {table}_{op}_version ON {table}')
+                cursor.execute(f'''
+                    CREATE TRIGGER {table}_{op}_version AFTER {op.upper()} ON {table}
+                    REFERENCING {transition} TABLE AS changed
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+                ''')
+    
+        # Trigram indexes let the ILIKE '%...%' student search use an index.
+        # Search still works without them if pg_trgm is unavailable.
+        cursor.execute('SAVEPOINT trgm')
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for column in ('name', 'father_name', 'admission_number'):
+                cursor.execute(f'''
+                    CREATE INDEX IF NOT EXISTS idx_students_{column}_trgm
+                    ON students USING gin ({column} gin_trgm_ops)
+                ''')
+            cursor.execute('RELEASE SAVEPOINT trgm')
+        except psycopg2.Error:
+            cursor.execute('ROLLBACK TO SAVEPOINT trgm')
+    
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    _prepared_generation += 1
 
-init_db()
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    click.echo('Database initialized.')
 
 def generate_admission_number():
-    conn = get_db()
-    cursor = conn.cursor()
     year = datetime.now().year
-    cursor.execute('SELECT COUNT(*) FROM students WHERE admission_number LIKE %s', (f'SL{year}%',))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return f'SL{year}{str(count + 1).zfill(4)}'
-
-def ensure_fee_records(student_id, admission_date, fee_per_month, discount=0.0):
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM students WHERE admission_number LIKE %s', (f'SL{year}%',))
+        count = cursor.fetchone()[0]
+    return f'SL{year}{count + 1:04d}'
+
+# (year, month) pairs from the admission month through the current month.
+# A malformed admission date yields no months and is logged with the student id
+# so the record can be corrected.
+def fee_months(admission_date, student_id=None):
     if not admission_date:
-        return
-    
-    conn = get_db()
-    cursor = conn.cursor()
+        return []
     
     try:
-        admission_dt = datetime.strptime(admission_date, '%Y-%m-%d')
-    except:
-        conn.close()
-        return
+        admission_dt = date.fromisoformat(admission_date)
+    except ValueError:
+        app.logger.warning('Student %s has an invalid admission date %r; no fee months generated',
+                           student_id, admission_date)
+        return []
     
-    current_dt = datetime.now()
-    net_fee = fee_per_month - discount
+    current_dt = date.today()
+    if admission_dt > current_dt:
+        return []
     
-    temp_dt = admission_dt
-    while temp_dt <= current_dt:
-        month = temp_dt.month
-        year = temp_dt.year
-        
-        cursor.execute('''
-            SELECT id FROM fees WHERE student_id = %s AND month = %s AND year = %s
-        ''', (student_id, month, year))
-        
-        if not cursor.fetchone():
-            cursor.execute('''
-                INSERT INTO fees (student_id, month, year, fee_amount, is_paid)
-                VALUES (%s, %s, %s, %s, 0)
-            ''', (student_id, month, year, net_fee))
-        
-        temp_dt = temp_dt.replace(day=1) + relativedelta(months=1)
+    first_month = admission_dt.year * 12 + admission_dt.month - 1
+    last_month = current_dt.year * 12 + current_dt.month - 1
     
-    conn.commit()
-    conn.close()
+    months = []
+    for index in range(first_month, last_month + 1):
+        year, month = divmod(index, 12)
+        months.append((year, month + 1))
+    return months
 
-def get_unpaid_months_details(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('''
-        SELECT month, year, fee_amount FROM fees 
-        WHERE student_id = %s AND is_paid = 0
-        ORDER BY year, month
-    ''', (student_id,))
-    
-    unpaid = cursor.fetchall()
-    conn.close()
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    unpaid_list = []
-    total_due = 0
+def ensure_fee_records(student_id, admission_date, fee_per_month, discount=0.0):
+    months = fee_months(admission_date, student_id)
+    if not months:
+        return
     
-    for record in unpaid:
-        month_name = months[record['month']]
-        year = record['year']
-        amount = record['fee_amount']
-        unpaid_list.append(f"{month_name} {year} - Rs {amount:.2f}")
-        total_due += amount
+    net_fee = fee_per_month - discount
+    rows = [(student_id, month, year, net_fee, 0) for year, month in months]
     
+    # The NOT EXISTS filter keeps months that already have a row from
+    # consuming fees_id_seq values; ON CONFLICT covers concurrent inserts.
+    with get_db() as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO fees (student_id, month, year, fee_amount, is_paid)
+            SELECT v.student_id, v.month, v.year, v.fee_amount, v.is_paid
+            FROM (VALUES %s) AS v (student_id, month, year, fee_amount, is_paid)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM fees f
+                WHERE f.student_id = v.student_id AND f.month = v.month AND f.year = v.year
+            )
+            ON CONFLICT (student_id, month, year) DO NOTHING
+        ''', rows, page_size=len(rows))
+        conn.commit()
+
+def load_fee_records(student_id):
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute('''
+            SELECT * FROM fees WHERE student_id = %s ORDER BY year, month
+        ''', (student_id,))
+        return cursor.fetchall()
+
+def format_unpaid_months(unpaid):
+    unpaid_list = [f"{MONTHS[record['month']]} {record['year']} - Rs {record['fee_amount']:.2f}"
+                   for record in unpaid]
+    total_due = sum(record['fee_amount'] for record in unpaid)
     return unpaid_list, total_due
 
-def build_whatsapp_url(mobile, student_name, admission_no, unpaid_list, total_due, demand_bill_url=''):
-    if not mobile:
-        return ''
-    
-    mobile = mobile.strip().replace('+91', '').replace(' ', '').replace('-', '')
-    
-    message = f"""✨ *Greetings from SANSA LEARN* ✨
+WA_REMINDER_INTRO = quote("""✨ *Greetings from SANSA LEARN* ✨
 
 Dear Parent/Guardian,
 
 This is a courteous reminder regarding the tuition fee status for your ward.
 
 👤 *Student Details:*
-Name: {student_name}
-Admission No: {admission_no}
+Name: """)
+WA_REMINDER_OUTSTANDING = quote("""
 
 📋 *Outstanding Fee Details:*
-"""
+""")
+WA_REMINDER_FOOTER = quote("\n\nKindly clear the outstanding amount at your earliest convenience. For any queries, feel free to contact us.\n\n🙏 Thank you for your cooperation.\n\n*SANSA LEARN*\nChandmari Road Kankarbagh\n📞 9296820840, 9153021229")
+
+_MOBILE_SEPARATORS = str.maketrans('', '', ' -')
+
+def normalize_mobile(mobile):
+    return mobile.strip().replace('+91', '').translate(_MOBILE_SEPARATORS)
+
+def build_whatsapp_url(mobile, student_name, admission_no, unpaid_list, total_due, demand_bill_url=''):
+    if not mobile:
+        return ''
     
     if unpaid_list:
-        for item in unpaid_list:
-            message += f"\n• {item}"
-        message += f"\n\n💰 *Total Amount Due: Rs {total_due:.2f}*"
+        fee_lines = ''.join(f"\n• {item}" for item in unpaid_list)
+        fee_lines += f"\n\n💰 *Total Amount Due: Rs {total_due:.2f}*"
     else:
-        message += "\nAll fees are up to date! ✅"
+        fee_lines = "\nAll fees are up to date! ✅"
     
     if demand_bill_url:
-        message += f"\n\n📄 Download Demand Bill:\n{demand_bill_url}"
-    
-    message += "\n\nKindly clear the outstanding amount at your earliest convenience. For any queries, feel free to contact us.\n\n🙏 Thank you for your cooperation.\n\n*SANSA LEARN*\nChandmari Road Kankarbagh\n📞 9296820840, 9153021229"
-    
-    encoded_message = quote(message)
-    whatsapp_url = f"https://wa.me/91{mobile}?text={encoded_message}"
+        fee_lines += f"\n\n📄 Download Demand Bill:\n{demand_bill_url}"
     
-    return whatsapp_url
+    return ''.join((
+        f"https://wa.me/91{normalize_mobile(mobile)}?text=",
+        WA_REMINDER_INTRO,
+        quote(f"{student_name}\nAdmission No: {admission_no}"),
+        WA_REMINDER_OUTSTANDING,
+        quote(fee_lines),
+        WA_REMINDER_FOOTER,
+    ))
 
-def build_registration_whatsapp_url(mobile, student_name, admission_no, father_name, class_name, profile_pdf_url):
-    if not mobile:
-        return ''
-    
-    mobile = mobile.strip().replace('+91', '').replace(' ', '').replace('-', '')
-    
-    message = f"""🎉 *REGISTRATION SUCCESSFUL!* 🎉
+WA_REGISTRATION_INTRO = quote("""🎉 *REGISTRATION SUCCESSFUL!* 🎉
 
 ━━━━━━━━━━━━━━━━━━━━━
      ✨ *SANSA LEARN* ✨
@@ -270,17 +542,8 @@ def build_registration_whatsapp_url(mobile, student_name, admission_no, father_n
 
 Dear Parents,
 
-We are delighted to welcome *{student_name}* to the SANSA LEARN family! 🌟
-
-📋 *Registration Details:*
-┌─────────────────────────
-│ 👤 Student: {student_name}
-│ 🔢 Admission No: *{admission_no}*
-│ 📚 Class: {class_name}
-└─────────────────────────
-
-📎 *Download Registration Card:*
-{profile_pdf_url}
+We are delighted to welcome *""")
+WA_REGISTRATION_FOOTER = quote("""
 
 ━━━━━━━━━━━━━━━━━━━━━
 
@@ -291,12 +554,30 @@ Chandmari Road, Kankarbagh
 _Thank you for trusting us with your child's education!_
 
 🙏 *Best Wishes*
-Team SANSA LEARN"""
+Team SANSA LEARN""")
+
+def build_registration_whatsapp_url(mobile, student_name, admission_no, father_name, class_name, profile_pdf_url):
+    if not mobile:
+        return ''
     
-    encoded_message = quote(message)
-    whatsapp_url = f"https://wa.me/91{mobile}?text={encoded_message}"
+    details = f"""{student_name}* to the SANSA LEARN family! 🌟
+
+📋 *Registration Details:*
+┌─────────────────────────
+│ 👤 Student: {student_name}
+│ 🔢 Admission No: *{admission_no}*
+│ 📚 Class: {class_name}
+└─────────────────────────
+
+📎 *Download Registration Card:*
+{profile_pdf_url}"""
     
-    return whatsapp_url
+    return ''.join((
+        f"https://wa.me/91{normalize_mobile(mobile)}?text=",
+        WA_REGISTRATION_INTRO,
+        quote(details),
+        WA_REGISTRATION_FOOTER,
+    ))
 
 def get_client_ip():
     forwarded_for = request.headers.get('X-Forwarded-For')
@@ -304,49 +585,125 @@ def get_client_ip():
         return forwarded_for.split(',')[0].strip()
     return request.remote_addr or 'Unknown'
 
-def create_session_record():
-    session_id = str(uuid.uuid4())
-    user_agent_string = request.headers.get('User-Agent', '')
+@lru_cache(maxsize=2048)
+def describe_user_agent(user_agent_string):
     user_agent = parse_user_agent(user_agent_string)
     
     device_name = str(user_agent.device.family) if user_agent.device.family else 'Unknown Device'
     os_name = f"{user_agent.os.family} {user_agent.os.version_string}".strip()
     browser_name = f"{user_agent.browser.family} {user_agent.browser.version_string}".strip()
+    return device_name, os_name, browser_name
+
+def create_session_record():
+    session_id = str(uuid.uuid4())
+    user_agent_string = request.headers.get('User-Agent', '')
+    device_name, os_name, browser_name = describe_user_agent(user_agent_string)
     ip_address = get_client_ip()
     
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO manager_sessions (session_id, ip_address, user_agent, device_name, os, browser)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    ''', (session_id, ip_address, user_agent_string, device_name, os_name, browser_name))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO manager_sessions (session_id, ip_address, user_agent, device_name, os, browser)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (session_id, ip_address, user_agent_string, device_name, os_name, browser_name))
+        conn.commit()
     
     return session_id
 
+# A session confirmed active is trusted for SESSION_CHECK_TTL seconds without
+# going back to the database. The cache is per process: a revoke made through
+# this worker evicts it at once, but one made by another gunicorn worker or
+# directly in the database can take up to SESSION_CHECK_TTL to apply. Set it
+# to 0 to check every request.
+SESSION_CHECK_TTL = int(os.environ.get('SESSION_CHECK_TTL', 60))
+_session_checked_at = {}
+
+def remember_session_check(session_id):
+    now = time.monotonic()
+    for other_id, checked_at in list(_session_checked_at.items()):
+        if now - checked_at >= SESSION_CHECK_TTL:
+            _session_checked_at.pop(other_id, None)
+    _session_checked_at[session_id] = now
+
+def forget_session_checks(keep=None):
+    for session_id in list(_session_checked_at):
+        if session_id != keep:
+            _session_checked_at.pop(session_id, None)
+
+# Requests served from the check cache only note the time here; a background
+# thread writes the latest last_seen_at per session every flush interval.
+LAST_SEEN_FLUSH_INTERVAL = 30
+_last_seen_pending = {}
+_last_seen_lock = threading.Lock()
+_last_seen_flusher = None
+
+def note_last_seen(session_id):
+    global _last_seen_flusher
+    with _last_seen_lock:
+        _last_seen_pending[session_id] = time.time()
+        if _last_seen_flusher is None:
+            _last_seen_flusher = threading.Thread(target=_flush_last_seen_loop, daemon=True)
+            _last_seen_flusher.start()
+            atexit.register(flush_last_seen)
+
+def flush_last_seen():
+    global _last_seen_pending
+    with _last_seen_lock:
+        pending, _last_seen_pending = _last_seen_pending, {}
+    if not pending:
+        return
+    
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            psycopg2.extras.execute_values(cursor, '''
+                UPDATE manager_sessions s SET last_seen_at = v.seen
+                FROM (VALUES %s) AS v (session_id, seen)
+                WHERE s.session_id = v.session_id AND s.is_active = 1 AND s.last_seen_at < v.seen
+            ''', list(pending.items()), template='(%s, to_timestamp(%s)::timestamp)')
+            conn.commit()
+    except Exception:
+        app.logger.exception('Failed to record session activity')
+
+def _flush_last_seen_loop():
+    while True:
+        time.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        flush_last_seen()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    flash('Uploaded file is too large.', 'error')
+    return redirect(request.referrer or url_for('dashboard'))
+
 @app.before_request
 def check_session_validity():
-    if session.get('authenticated') and session.get('session_record_id'):
-        conn = get_db()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute('''
-            SELECT is_active FROM manager_sessions WHERE session_id = %s
-        ''', (session.get('session_record_id'),))
-        result = cursor.fetchone()
+    session_id = session.get('session_record_id')
+    if session.get('authenticated') and session_id:
+        checked_at = _session_checked_at.get(session_id)
+        if checked_at is not None and time.monotonic() - checked_at < SESSION_CHECK_TTL:
+            note_last_seen(session_id)
+            return
         
-        if result and result['is_active'] == 1:
-            cursor.execute('''
-                UPDATE manager_sessions SET last_seen_at = CURRENT_TIMESTAMP WHERE session_id = %s
-            ''', (session.get('session_record_id'),))
+        with get_db() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            execute_prepared(cursor, 'touch_session', '''
+                UPDATE manager_sessions
+                SET last_seen_at = CASE WHEN is_active = 1 THEN CURRENT_TIMESTAMP ELSE last_seen_at END
+                WHERE session_id = %s
+                RETURNING is_active
+            ''', (session_id,))
+            result = cursor.fetchone()
             conn.commit()
-        elif result and result['is_active'] == 0:
-            conn.close()
+        
+        if result and result['is_active'] == 1:
+            remember_session_check(session_id)
+        else:
+            _session_checked_at.pop(session_id, None)
+        
+        if result and result['is_active'] == 0:
             session.clear()
             flash('Your session was terminated by the administrator.', 'warning')
             return redirect(url_for('login'))
-        
-        conn.close()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -376,13 +733,13 @@ def login():
 @app.route('/logout')
 def logout():
     if session.get('session_record_id'):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE manager_sessions SET is_active = 0 WHERE session_id = %s
-        ''', (session.get('session_record_id'),))
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE manager_sessions SET is_active = 0 WHERE session_id = %s
+            ''', (session.get('session_record_id'),))
+            conn.commit()
+        _session_checked_at.pop(session.get('session_record_id'), None)
     session.clear()
     flash('You have been logged out successfully.', 'success')
     return redirect(url_for('login'))
@@ -390,29 +747,20 @@ def logout():
 @app.route('/')
 @login_required
 def dashboard():
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM students')
-    total_students = cursor.fetchone()[0]
+    now = datetime.now()
+    current_month, current_year = now.month, now.year
     
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    
-    cursor.execute('''
-        SELECT COALESCE(SUM(fee_amount), 0) FROM fees 
-        WHERE month = %s AND year = %s AND is_paid = 1
-    ''', (current_month, current_year))
-    total_paid_this_month = cursor.fetchone()[0]
-    
-    cursor.execute('''
-        SELECT COALESCE(SUM(f.fee_amount), 0) FROM fees f
-        JOIN students s ON f.student_id = s.id
-        WHERE f.month = %s AND f.year = %s AND f.is_paid = 0
-    ''', (current_month, current_year))
-    total_pending_this_month = cursor.fetchone()[0]
-    
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM students),
+                COALESCE(SUM(fee_amount) FILTER (WHERE is_paid = 1), 0),
+                COALESCE(SUM(fee_amount) FILTER (WHERE is_paid = 0), 0)
+            FROM fees
+            WHERE month = %s AND year = %s
+        ''', (current_month, current_year))
+        total_students, total_paid_this_month, total_pending_this_month = cursor.fetchone()
     
     return render_template('dashboard.html', 
                          total_students=total_students,
@@ -424,30 +772,44 @@ def dashboard():
 def uploaded_file(filename):
     return send_from_directory(UPLOAD_FOLDER, filename)
 
+# Thumbnails for photos saved before thumbnails existed (or restored from an
+# older backup) are created on first request.
+@app.route('/uploads/thumbs/<filename>')
+@login_required
+def photo_thumbnail(filename):
+    filename = secure_filename(filename)
+    thumb = thumbnail_name(filename)
+    if not os.path.exists(os.path.join(THUMB_FOLDER, thumb)):
+        try:
+            img = _photo_rgb(Image.open(os.path.join(UPLOAD_FOLDER, filename)))
+        except (OSError, ValueError):
+            return send_from_directory(UPLOAD_FOLDER, filename)
+        save_thumbnail(img, filename)
+    return send_from_directory(THUMB_FOLDER, thumb)
+
 @app.route('/students')
 @login_required
 def list_students():
     search_query = request.args.get('search', '')
     search_type = request.args.get('search_type', 'name')
     
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    if search_query:
-        if search_type == 'admission':
-            cursor.execute('SELECT * FROM students WHERE admission_number ILIKE %s ORDER BY created_at DESC', 
-                         (f'%{search_query}%',))
-        elif search_type == 'father':
-            cursor.execute('SELECT * FROM students WHERE father_name ILIKE %s ORDER BY created_at DESC', 
-                         (f'%{search_query}%',))
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        if search_query:
+            if search_type == 'admission':
+                cursor.execute('SELECT * FROM students WHERE admission_number ILIKE %s ORDER BY created_at DESC', 
+                             (f'%{search_query}%',))
+            elif search_type == 'father':
+                cursor.execute('SELECT * FROM students WHERE father_name ILIKE %s ORDER BY created_at DESC', 
+                             (f'%{search_query}%',))
+            else:
+                cursor.execute('SELECT * FROM students WHERE name ILIKE %s ORDER BY created_at DESC', 
+                             (f'%{search_query}%',))
         else:
-            cursor.execute('SELECT * FROM students WHERE name ILIKE %s ORDER BY created_at DESC', 
-                         (f'%{search_query}%',))
-    else:
-        cursor.execute('SELECT * FROM students ORDER BY created_at DESC')
-    
-    students = cursor.fetchall()
-    conn.close()
+            cursor.execute('SELECT * FROM students ORDER BY created_at DESC')
+        
+        students = cursor.fetchall()
     
     return render_template('students.html', students=students, 
                          search_query=search_query, search_type=search_type)
@@ -458,54 +820,51 @@ def add_student():
     if request.method == 'POST':
         try:
             admission_number = generate_admission_number()
+            admission_date = request.form.get('admission_date', datetime.now().strftime('%Y-%m-%d'))
+            fee_per_month = float(request.form.get('fee_per_month', 0))
+            discount = float(request.form.get('discount', 0))
             
             photo_path = None
             if 'photo' in request.files:
                 file = request.files['photo']
                 if file and file.filename and allowed_file(file.filename):
-                    filename = secure_filename(f"{admission_number}_{file.filename}")
-                    filepath = os.path.join(UPLOAD_FOLDER, filename)
-                    file.save(filepath)
-                    photo_path = filepath
+                    photo_path = save_photo(file, admission_number)
             
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO students (
-                    admission_number, photo_path, name, father_name, mother_name,
-                    dob, gender, class, board, medium, school_name, address,
-                    mobile1, mobile2, fee_per_month, discount, admission_date, other_details
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (
-                admission_number,
-                photo_path,
-                request.form['name'],
-                request.form['father_name'],
-                request.form.get('mother_name', ''),
-                request.form.get('dob', ''),
-                request.form.get('gender', ''),
-                request.form.get('class', ''),
-                request.form.get('board', ''),
-                request.form.get('medium', ''),
-                request.form.get('school_name', ''),
-                request.form.get('address', ''),
-                request.form.get('mobile1', ''),
-                request.form.get('mobile2', ''),
-                float(request.form.get('fee_per_month', 0)),
-                float(request.form.get('discount', 0)),
-                request.form.get('admission_date', datetime.now().strftime('%Y-%m-%d')),
-                request.form.get('other_details', '')
-            ))
-            
-            student_id = cursor.fetchone()[0]
-            conn.commit()
-            conn.close()
+            with get_db() as conn:
+                cursor = conn.cursor()
+                
+                execute_prepared(cursor, 'insert_student', '''
+                    INSERT INTO students (
+                        admission_number, photo_path, name, father_name, mother_name,
+                        dob, gender, class, board, medium, school_name, address,
+                        mobile1, mobile2, fee_per_month, discount, admission_date, other_details
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (
+                    admission_number,
+                    photo_path,
+                    request.form['name'],
+                    request.form['father_name'],
+                    request.form.get('mother_name', ''),
+                    request.form.get('dob', ''),
+                    request.form.get('gender', ''),
+                    request.form.get('class', ''),
+                    request.form.get('board', ''),
+                    request.form.get('medium', ''),
+                    request.form.get('school_name', ''),
+                    request.form.get('address', ''),
+                    request.form.get('mobile1', ''),
+                    request.form.get('mobile2', ''),
+                    fee_per_month,
+                    discount,
+                    admission_date,
+                    request.form.get('other_details', '')
+                ))
+                
+                student_id = cursor.fetchone()[0]
+                conn.commit()
             
-            ensure_fee_records(student_id, request.form.get('admission_date', datetime.now().strftime('%Y-%m-%d')),
-                             float(request.form.get('fee_per_month', 0)),
-                             float(request.form.get('discount', 0)))
+            ensure_fee_records(student_id, admission_date, fee_per_month, discount)
             
             return redirect(url_for('registration_success', student_id=student_id))
             
@@ -518,17 +877,16 @@ def add_student():
 @app.route('/student/<int:student_id>/registration-success')
 @login_required
 def registration_success(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        execute_prepared(cursor, 'student_by_id', f'{SELECT_STUDENT} WHERE id = %s', (student_id,))
+        student = cursor.fetchone()
     
     if not student:
         flash('Student not found', 'error')
         return redirect(url_for('list_students'))
     
-    conn.close()
+    run_in_background(prerender_student_profile, student['admission_number'])
     
     token = generate_pdf_token(student['admission_number'])
     profile_pdf_url = url_for('public_student_profile', 
@@ -553,28 +911,25 @@ def registration_success(student_id):
 @app.route('/student/<int:student_id>')
 @login_required
 def view_student(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        execute_prepared(cursor, 'student_by_id', f'{SELECT_STUDENT} WHERE id = %s', (student_id,))
+        student = cursor.fetchone()
     
     if not student:
         flash('Student not found', 'error')
         return redirect(url_for('list_students'))
     
-    ensure_fee_records(student_id, student['admission_date'], 
-                      student['fee_per_month'] or 0, student['discount'] or 0)
-    
-    cursor.execute('''
-        SELECT * FROM fees WHERE student_id = %s ORDER BY year, month
-    ''', (student_id,))
-    all_fee_records = cursor.fetchall()
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
+    # Months are only backfilled when one is actually missing, so an ordinary
+    # view is read-only.
+    all_fee_records = load_fee_records(student_id)
+    existing = {(fee['year'], fee['month']) for fee in all_fee_records}
+    if any(month not in existing for month in fee_months(student['admission_date'], student_id)):
+        ensure_fee_records(student_id, student['admission_date'], 
+                          student['fee_per_month'] or 0, student['discount'] or 0)
+        all_fee_records = load_fee_records(student_id)
     
-    unpaid_list, total_due = get_unpaid_months_details(student_id)
+    unpaid_list, total_due = format_unpaid_months([fee for fee in all_fee_records if not fee['is_paid']])
     
     token = generate_pdf_token(student['admission_number'])
     demand_bill_url = url_for('public_demand_bill', 
@@ -590,79 +945,70 @@ def view_student(student_id):
         demand_bill_url
     )
     
-    conn.close()
-    
     return render_template('view_student.html', 
                          student=student, 
                          fee_records=all_fee_records,
-                         months=months,
+                         months=MONTHS,
                          whatsapp_url=whatsapp_url,
                          total_due=total_due)
 
 @app.route('/student/<int:student_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_student(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
     if request.method == 'POST':
         try:
-            cursor.execute('SELECT photo_path FROM students WHERE id = %s', (student_id,))
-            result = cursor.fetchone()
-            current_photo = result['photo_path'] if result else None
-            photo_path = current_photo
-            
-            if 'photo' in request.files:
-                file = request.files['photo']
-                if file and file.filename and allowed_file(file.filename):
-                    cursor.execute('SELECT admission_number FROM students WHERE id = %s', (student_id,))
-                    result = cursor.fetchone()
-                    admission_number = result['admission_number'] if result else None
-                    filename = secure_filename(f"{admission_number}_{file.filename}")
-                    filepath = os.path.join(UPLOAD_FOLDER, filename)
-                    file.save(filepath)
-                    photo_path = filepath
-            
-            cursor.execute('''
-                UPDATE students SET
-                    photo_path = %s, name = %s, father_name = %s, mother_name = %s,
-                    dob = %s, gender = %s, class = %s, board = %s, medium = %s,
-                    school_name = %s, address = %s, mobile1 = %s, mobile2 = %s,
-                    fee_per_month = %s, discount = %s, admission_date = %s, other_details = %s
-                WHERE id = %s
-            ''', (
-                photo_path,
-                request.form['name'],
-                request.form['father_name'],
-                request.form.get('mother_name', ''),
-                request.form.get('dob', ''),
-                request.form.get('gender', ''),
-                request.form.get('class', ''),
-                request.form.get('board', ''),
-                request.form.get('medium', ''),
-                request.form.get('school_name', ''),
-                request.form.get('address', ''),
-                request.form.get('mobile1', ''),
-                request.form.get('mobile2', ''),
-                float(request.form.get('fee_per_month', 0)),
-                float(request.form.get('discount', 0)),
-                request.form.get('admission_date', ''),
-                request.form.get('other_details', ''),
-                student_id
-            ))
-            
-            conn.commit()
+            with get_db() as conn:
+                cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                
+                cursor.execute('SELECT photo_path, admission_number FROM students WHERE id = %s', (student_id,))
+                result = cursor.fetchone()
+                photo_path = result['photo_path'] if result else None
+                admission_number = result['admission_number'] if result else None
+                
+                if 'photo' in request.files:
+                    file = request.files['photo']
+                    if file and file.filename and allowed_file(file.filename):
+                        photo_path = save_photo(file, admission_number)
+                
+                execute_prepared(cursor, 'update_student', '''
+                    UPDATE students SET
+                        photo_path = %s, name = %s, father_name = %s, mother_name = %s,
+                        dob = %s, gender = %s, class = %s, board = %s, medium = %s,
+                        school_name = %s, address = %s, mobile1 = %s, mobile2 = %s,
+                        fee_per_month = %s, discount = %s, admission_date = %s, other_details = %s
+                    WHERE id = %s
+                ''', (
+                    photo_path,
+                    request.form['name'],
+                    request.form['father_name'],
+                    request.form.get('mother_name', ''),
+                    request.form.get('dob', ''),
+                    request.form.get('gender', ''),
+                    request.form.get('class', ''),
+                    request.form.get('board', ''),
+                    request.form.get('medium', ''),
+                    request.form.get('school_name', ''),
+                    request.form.get('address', ''),
+                    request.form.get('mobile1', ''),
+                    request.form.get('mobile2', ''),
+                    float(request.form.get('fee_per_month', 0)),
+                    float(request.form.get('discount', 0)),
+                    request.form.get('admission_date', ''),
+                    request.form.get('other_details', ''),
+                    student_id
+                ))
+                
+                conn.commit()
             flash('Student updated successfully!', 'success')
             return redirect(url_for('view_student', student_id=student_id))
             
         except Exception as e:
             flash(f'Error updating student: {str(e)}', 'error')
-        finally:
-            conn.close()
     
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        execute_prepared(cursor, 'student_by_id', f'{SELECT_STUDENT} WHERE id = %s', (student_id,))
+        student = cursor.fetchone()
     
     if not student:
         flash('Student not found', 'error')
@@ -674,17 +1020,19 @@ def edit_student(student_id):
 @login_required
 def delete_student(student_id):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            
+            # Fees go with the student through ON DELETE CASCADE.
+            cursor.execute('DELETE FROM students WHERE id = %s RETURNING photo_path', (student_id,))
+            result = cursor.fetchone()
+            conn.commit()
         
-        cursor.execute('SELECT photo_path FROM students WHERE id = %s', (student_id,))
-        result = cursor.fetchone()
         if result and result[0] and os.path.exists(result[0]):
             os.remove(result[0])
-        
-        cursor.execute('DELETE FROM students WHERE id = %s', (student_id,))
-        conn.commit()
-        conn.close()
+            thumb_path = os.path.join(THUMB_FOLDER, thumbnail_name(os.path.basename(result[0])))
+            if os.path.exists(thumb_path):
+                os.remove(thumb_path)
         
         flash('Student deleted successfully!', 'success')
     except Exception as e:
@@ -695,56 +1043,46 @@ def delete_student(student_id):
 @app.route('/fees')
 @login_required
 def fee_management():
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('''
-        SELECT s.id, s.admission_number, s.name, s.father_name, s.fee_per_month, s.discount
-        FROM students s
-        ORDER BY s.name
-    ''')
-    students = cursor.fetchall()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute('''
+            SELECT s.id, s.admission_number, s.name, s.father_name, s.fee_per_month, s.discount
+            FROM students s
+            ORDER BY s.name
+        ''')
+        students = cursor.fetchall()
     
     return render_template('fee_management.html', students=students)
 
 @app.route('/student/<int:student_id>/fees')
 @login_required
 def student_fees(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
-    
-    if not student:
-        flash('Student not found', 'error')
-        return redirect(url_for('fee_management'))
-    
-    cursor.execute('''
-        SELECT * FROM fees WHERE student_id = %s ORDER BY year DESC, month DESC
-    ''', (student_id,))
-    fee_records = cursor.fetchall()
-    
-    cursor.execute('''
-        SELECT COALESCE(SUM(fee_amount), 0) FROM fees 
-        WHERE student_id = %s AND is_paid = 1
-    ''', (student_id,))
-    total_paid = cursor.fetchone()[0]
-    
-    cursor.execute('''
-        SELECT COALESCE(SUM(fee_amount), 0) FROM fees 
-        WHERE student_id = %s AND is_paid = 0
-    ''', (student_id,))
-    total_pending = cursor.fetchone()[0]
-    
-    conn.close()
-    
-    months = ['January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        execute_prepared(cursor, 'student_by_id', f'{SELECT_STUDENT} WHERE id = %s', (student_id,))
+        student = cursor.fetchone()
+        
+        if not student:
+            flash('Student not found', 'error')
+            return redirect(url_for('fee_management'))
+        
+        cursor.execute('''
+            SELECT * FROM fees WHERE student_id = %s ORDER BY year DESC, month DESC
+        ''', (student_id,))
+        fee_records = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT
+                (SELECT COALESCE(SUM(fee_amount), 0) FROM fees
+                 WHERE student_id = %s AND is_paid = 1),
+                (SELECT COALESCE(SUM(fee_amount), 0) FROM fees
+                 WHERE student_id = %s AND is_paid = 0)
+        ''', (student_id, student_id))
+        total_paid, total_pending = cursor.fetchone()
     
     return render_template('student_fees.html', student=student, 
-                         fee_records=fee_records, months=months,
+                         fee_records=fee_records, months=MONTHS[1:],
                          total_paid=total_paid, total_pending=total_pending)
 
 @app.route('/student/<int:student_id>/fees/add', methods=['POST'])
@@ -759,29 +1097,21 @@ def add_fee_record(student_id):
         payment_mode = request.form.get('payment_mode', '')
         remarks = request.form.get('remarks', '')
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id FROM fees WHERE student_id = %s AND month = %s AND year = %s
-        ''', (student_id, month, year))
-        existing = cursor.fetchone()
-        
-        if existing:
-            cursor.execute('''
-                UPDATE fees SET fee_amount = %s, is_paid = %s, payment_date = %s,
-                payment_mode = %s, remarks = %s WHERE id = %s
-            ''', (fee_amount, is_paid, payment_date, payment_mode, remarks, existing[0]))
-        else:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            
             cursor.execute('''
                 INSERT INTO fees (student_id, month, year, fee_amount, is_paid, 
                                 payment_date, payment_mode, remarks)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (student_id, month, year) DO UPDATE SET
+                    fee_amount = EXCLUDED.fee_amount, is_paid = EXCLUDED.is_paid,
+                    payment_date = EXCLUDED.payment_date, payment_mode = EXCLUDED.payment_mode,
+                    remarks = EXCLUDED.remarks
             ''', (student_id, month, year, fee_amount, is_paid, 
                   payment_date, payment_mode, remarks))
-        
-        conn.commit()
-        conn.close()
+            
+            conn.commit()
         
         flash('Fee record saved successfully!', 'success')
     except Exception as e:
@@ -793,16 +1123,15 @@ def add_fee_record(student_id):
 @login_required
 def delete_fee_record(fee_id):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT student_id FROM fees WHERE id = %s', (fee_id,))
-        result = cursor.fetchone()
-        student_id = result[0] if result else None
-        
-        cursor.execute('DELETE FROM fees WHERE id = %s', (fee_id,))
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT student_id FROM fees WHERE id = %s', (fee_id,))
+            result = cursor.fetchone()
+            student_id = result[0] if result else None
+            
+            cursor.execute('DELETE FROM fees WHERE id = %s', (fee_id,))
+            conn.commit()
         
         flash('Fee record deleted successfully!', 'success')
         
@@ -817,28 +1146,23 @@ def delete_fee_record(fee_id):
 @login_required
 def toggle_fee_status(student_id, month, year):
     try:
-        conn = get_db()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        cursor.execute('''
-            SELECT id, is_paid FROM fees WHERE student_id = %s AND month = %s AND year = %s
-        ''', (student_id, month, year))
-        
-        fee_record = cursor.fetchone()
-        
-        if fee_record:
-            new_status = 0 if fee_record['is_paid'] else 1
-            payment_date = datetime.now().strftime('%Y-%m-%d') if new_status else None
+        with get_db() as conn:
+            cursor = conn.cursor()
             
+            # Flip in place; CASE sees the pre-update is_paid, RETURNING the new one.
             cursor.execute('''
-                UPDATE fees SET is_paid = %s, payment_date = %s, payment_mode = %s
-                WHERE id = %s
-            ''', (new_status, payment_date, 'Cash' if new_status else None, fee_record['id']))
+                UPDATE fees SET is_paid = 1 - is_paid,
+                    payment_date = CASE WHEN is_paid = 0 THEN %s END,
+                    payment_mode = CASE WHEN is_paid = 0 THEN 'Cash' END
+                WHERE student_id = %s AND month = %s AND year = %s
+                RETURNING is_paid
+            ''', (datetime.now().strftime('%Y-%m-%d'), student_id, month, year))
             
+            fee_record = cursor.fetchone()
             conn.commit()
-            flash(f'Fee marked as {"paid" if new_status else "unpaid"}!', 'success')
-        
-        conn.close()
+            
+            if fee_record:
+                flash(f'Fee marked as {"paid" if fee_record[0] else "unpaid"}!', 'success')
     except Exception as e:
         flash(f'Error updating fee status: {str(e)}', 'error')
     
@@ -849,75 +1173,183 @@ def toggle_fee_status(student_id, month, year):
 def students_grid():
     year = request.args.get('year', datetime.now().year, type=int)
     
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT version FROM table_versions ORDER BY table_name')
+        versions = tuple(row[0] for row in cursor.fetchall())
     
-    cursor.execute('SELECT * FROM students ORDER BY admission_number')
-    students = cursor.fetchall()
-    
-    student_fees = {}
-    for student in students:
-        cursor.execute('''
-            SELECT month, is_paid FROM fees 
-            WHERE student_id = %s AND year = %s
-        ''', (student['id'], year))
-        
-        fees = {row['month']: row['is_paid'] for row in cursor.fetchall()}
-        student_fees[student['id']] = fees
-    
-    available_years = []
-    cursor.execute('SELECT DISTINCT year FROM fees ORDER BY year DESC')
-    available_years = [row['year'] for row in cursor.fetchall()]
-    
-    if year not in available_years and available_years:
-        available_years.append(year)
-        available_years.sort(reverse=True)
-    
-    conn.close()
-    
-    months = ['January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
+    grid_rows, available_years = render_grid_rows(year, versions)
     
     return render_template('students_grid.html', 
-                         students=students,
-                         student_fees=student_fees,
-                         months=months,
+                         grid_rows=grid_rows,
+                         months=MONTHS[1:],
                          current_year=year,
                          available_years=available_years)
 
-@app.route('/student/<int:student_id>/receipt/<int:fee_id>')
-@login_required
-def generate_receipt(student_id, fee_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
-    
-    cursor.execute('SELECT * FROM fees WHERE id = %s', (fee_id,))
-    fee = cursor.fetchone()
-    
-    cursor.execute('SELECT * FROM institute_info WHERE id = 1')
-    institute = cursor.fetchone()
-    
-    conn.close()
-    
-    if not student or not fee:
-        flash('Student or fee record not found', 'error')
-        return redirect(url_for('fee_management'))
-    
-    filename = f"receipt_{student['admission_number']}_{fee['month']}_{fee['year']}.pdf"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    c = canvas.Canvas(filepath, pagesize=A4)
-    width, height = A4
+# The grid body only changes when students or fees do, so it is rendered once
+# per (year, table versions) and reused until a write bumps a version.
+@lru_cache(maxsize=32)
+def render_grid_rows(year, versions):
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
+        
+        cursor.execute('SELECT id, admission_number, name FROM students ORDER BY admission_number')
+        students = cursor.fetchall()
+        
+        # One row per student-month for the year; plain tuples keep this loop cheap.
+        cursor = conn.cursor()
+        execute_prepared(cursor, 'grid_fees', 'SELECT student_id, month, is_paid FROM fees WHERE year = %s', (year,))
+        student_fees = defaultdict(dict)
+        for student_id, month, is_paid in cursor:
+            student_fees[student_id][month] = is_paid
+        
+        cursor.execute('SELECT year FROM fees UNION SELECT %s ORDER BY year DESC', (year,))
+        available_years = [row[0] for row in cursor]
+    
+    if not students:
+        return None, available_years
+    
+    grid_rows = render_template('_students_grid_rows.html',
+                                students=students,
+                                student_fees=student_fees,
+                                current_year=year)
+    return grid_rows, available_years
+
+# Generated PDFs are cached under a hash of everything they are drawn from, so
+# any change to the student, fee rows, institute details or branding images
+# produces a new key. Bump PDF_TEMPLATE_VERSION when the layout changes.
+PDF_TEMPLATE_VERSION = 4
+PDF_CACHE_FOLDER = os.path.join(PDF_FOLDER, 'cache')
+LOGO_PATH = 'static/logo/logo.png'
+SIGNATURE_PATH = 'static/logo/signature.jpg'
+PDF_ASSETS = (LOGO_PATH, SIGNATURE_PATH)
+
+# Branding images are prepared once and reused across PDFs until the file on
+# disk changes. The logo is drawn at most ~80pt wide, so non-JPEG images are
+# downscaled first; otherwise every PDF re-compresses the full-size bitmap.
+# Opaque ones are then re-encoded as JPEG, which reportlab embeds as is and
+# which is far smaller than the deflated RGB it would otherwise write.
+# JPEGs are left alone for the same reason. Only the encoded bytes are cached:
+# an ImageReader reads through a single file handle, so sharing one between
+# threads rendering at the same time could embed a truncated image. Each call
+# wraps the bytes in a fresh reader instead.
+BRANDING_IMAGE_MAX_PX = 400
+BRANDING_JPEG_QUALITY = 85
+_branding_images = {}
+
+# The branding files only change on a backup restore (which refreshes this
+# straight away) or by hand, so their mtimes are re-read at most once a minute
+# instead of on every PDF.
+BRANDING_TTL = 60
+_branding_mtimes = ({}, None)
+
+def branding_mtimes(refresh=False):
+    global _branding_mtimes
+    mtimes, checked_at = _branding_mtimes
+    if refresh or checked_at is None or time.monotonic() - checked_at >= BRANDING_TTL:
+        mtimes = {}
+        for path in PDF_ASSETS:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        _branding_mtimes = (mtimes, time.monotonic())
+    return mtimes
+
+def branding_image(path):
+    mtime = branding_mtimes()[path]
+    if mtime is None:
+        return None
+    cached = _branding_images.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            img = Image.open(path)
+            if img.format != 'JPEG':
+                img.thumbnail((BRANDING_IMAGE_MAX_PX, BRANDING_IMAGE_MAX_PX), Image.LANCZOS)
+                buffer = io.BytesIO()
+                if img.mode in ('RGB', 'L'):
+                    img.save(buffer, 'JPEG', quality=BRANDING_JPEG_QUALITY, optimize=True)
+                else:
+                    img.save(buffer, 'PNG')
+                data = buffer.getvalue()
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+        except Exception:
+            return None
+        cached = (mtime, data)
+        _branding_images[path] = cached
+    return ImageReader(io.BytesIO(cached[1]))
+
+INSTITUTE_TTL = 300
+_institute_cache = (None, None)
+
+def get_institute_info():
+    global _institute_cache
+    row, loaded_at = _institute_cache
+    if loaded_at is None or time.monotonic() - loaded_at >= INSTITUTE_TTL:
+        with get_db() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cursor.execute('SELECT * FROM institute_info WHERE id = 1')
+            row = cursor.fetchone()
+        row = dict(row) if row else None
+        _institute_cache = (row, time.monotonic())
+    return row
+
+PDF_CACHE_MAX_AGE = 7 * 24 * 3600
+_pdf_cache_pruned_at = None
+
+# Returns (pdf, etag). pdf is the cached file's path on a hit. On a miss the
+# PDF is rendered into memory, written to the cache and returned as a BytesIO,
+# so the fresh copy is served without reading it back from disk. send_file
+# accepts either. The etag is the content hash, so it matches on both paths and
+# an unchanged document is answered with a 304.
+def cached_pdf(kind, content, build_fn):
+    mtimes = branding_mtimes()
+    assets = [mtimes[p] for p in PDF_ASSETS]
+    payload = json.dumps([PDF_TEMPLATE_VERSION, kind, assets, content], default=str, sort_keys=True)
+    etag = hashlib.sha256(payload.encode()).hexdigest()
+    filepath = os.path.join(PDF_CACHE_FOLDER, f"{kind}_{etag}.pdf")
+    if os.path.exists(filepath):
+        return filepath, etag
+    
+    buffer = io.BytesIO()
+    build_fn(buffer)
+    tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+    os.replace(tmp_path, filepath)
+    prune_pdf_cache()
+    
+    buffer.seek(0)
+    return buffer, etag
+
+def prune_pdf_cache():
+    global _pdf_cache_pruned_at
+    now = time.time()
+    if _pdf_cache_pruned_at is not None and now - _pdf_cache_pruned_at < 3600:
+        return
+    _pdf_cache_pruned_at = now
     
-    logo_path = 'static/logo/logo.png'
-    if os.path.exists(logo_path):
+    for entry in os.scandir(PDF_CACHE_FOLDER):
+        try:
+            if now - entry.stat().st_mtime > PDF_CACHE_MAX_AGE:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+# Content streams are deflated (receipts are often fetched over mobile data),
+# and invariant output makes a re-render of the same content byte-identical.
+def _new_canvas(output):
+    return canvas.Canvas(output, pagesize=A4, pageCompression=1, invariant=1)
+
+def _draw_header(c, width, height, institute, title):
+    logo = branding_image(LOGO_PATH)
+    if logo:
         try:
             logo_width = 80
             logo_height = 80
-            c.drawImage(logo_path, (width - logo_width) / 2, height - 90, 
+            c.drawImage(logo, (width - logo_width) / 2, height - 90, 
                        width=logo_width, height=logo_height, preserveAspectRatio=True, mask='auto')
         except:
             pass
@@ -926,266 +1358,124 @@ def generate_receipt(student_id, fee_id):
     c.drawCentredString(width/2, height - 110, "SANSA LEARN")
     
     c.setFont("Helvetica", 10)
-    c.drawCentredString(width/2, height - 130, institute['address'])
-    c.drawCentredString(width/2, height - 145, f"Contact: {institute['contact']}")
+    c.drawCentredString(width/2, height - 130, institute['address'] if institute else '')
+    c.drawCentredString(width/2, height - 145, f"Contact: {institute['contact']}" if institute else '')
     
     c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(width/2, height - 175, "FEE RECEIPT")
-    
-    y = height - 215
-    c.setFont("Helvetica", 11)
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    receipt_no = f"REC{fee['year']}{str(fee['month']).zfill(2)}{str(fee['id']).zfill(4)}"
-    c.drawString(50, y, f"Receipt No: {receipt_no}")
-    c.drawRightString(width - 50, y, f"Date: {fee['payment_date']}")
-    
-    y -= 30
-    c.line(50, y, width - 50, y)
-    y -= 25
-    
+    c.drawCentredString(width/2, height - 175, title)
+
+# Draws label lines as one text object (a single font setting and BT/ET block)
+# and returns the baseline of the last line.
+def _draw_lines(c, x, y, lines, leading=18):
+    text = c.beginText(x, y)
+    text.setFont("Helvetica", 10, leading)
+    for line in lines:
+        text.textLine(line)
+    c.drawText(text)
+    return y - leading * (len(lines) - 1)
+
+# Bold labels and their values as two text objects, one row per leading step.
+# Returns the y just below the last row.
+def _draw_label_rows(c, label_x, value_x, y, rows, leading=18):
+    labels = c.beginText(label_x, y)
+    labels.setFont("Helvetica-Bold", 10, leading)
+    values = c.beginText(value_x, y)
+    values.setFont("Helvetica", 10, leading)
+    for label, value in rows:
+        labels.textLine(label)
+        values.textLine(str(value))
+    c.drawText(labels)
+    c.drawText(values)
+    return y - leading * len(rows)
+
+def _draw_student_details(c, y, student):
     c.setFont("Helvetica-Bold", 11)
     c.drawString(50, y, "Student Details:")
     y -= 20
     
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Admission No: {student['admission_number']}")
-    y -= 18
-    c.drawString(70, y, f"Name: {student['name']}")
-    y -= 18
-    c.drawString(70, y, f"Father's Name: {student['father_name']}")
-    y -= 18
-    c.drawString(70, y, f"Class: {student['class']}")
-    
-    y -= 30
-    c.line(50, y, width - 50, y)
-    y -= 25
-    
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Payment Details:")
-    y -= 20
-    
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Fee Month: {months[fee['month']]} {fee['year']}")
-    y -= 18
-    c.drawString(70, y, f"Amount Paid: Rs. {fee['fee_amount']:.2f}")
-    y -= 18
-    c.drawString(70, y, f"Payment Mode: {fee['payment_mode']}")
-    if fee['remarks']:
-        y -= 18
-        c.drawString(70, y, f"Remarks: {fee['remarks']}")
-    
-    y -= 30
-    c.line(50, y, width - 50, y)
-    
-    y = 150
+    return _draw_lines(c, 70, y, [
+        f"Admission No: {student['admission_number']}",
+        f"Name: {student['name']}",
+        f"Father's Name: {student['father_name']}",
+        f"Class: {student['class']}",
+    ])
+
+def _draw_signature_block(c, y=150):
     c.setFont("Helvetica", 10)
     c.drawString(50, y, "For Sansa Learn")
     
-    signature_path = 'static/logo/signature.jpg'
-    if os.path.exists(signature_path):
+    signature = branding_image(SIGNATURE_PATH)
+    if signature:
         try:
             sig_width = 150
             sig_height = 50
-            c.drawImage(signature_path, 50, y - 60, width=sig_width, height=sig_height)
+            c.drawImage(signature, 50, y - 60, width=sig_width, height=sig_height)
         except:
             pass
     
     y -= 70
     c.drawString(50, y, "Management Signature")
-    
-    c.save()
-    
-    return send_file(filepath, as_attachment=True)
 
-@app.route('/student/<int:student_id>/demand')
-@login_required
-def generate_demand_bill(student_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE id = %s', (student_id,))
-    student = cursor.fetchone()
-    
-    cursor.execute('''
-        SELECT * FROM fees WHERE student_id = %s AND is_paid = 0 
-        ORDER BY year, month
-    ''', (student_id,))
-    unpaid_fees = cursor.fetchall()
-    
-    cursor.execute('SELECT * FROM institute_info WHERE id = 1')
-    institute = cursor.fetchone()
-    
-    conn.close()
-    
-    if not student:
-        flash('Student not found', 'error')
-        return redirect(url_for('fee_management'))
-    
-    filename = f"demand_{student['admission_number']}_{datetime.now().strftime('%Y%m%d')}.pdf"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    c = canvas.Canvas(filepath, pagesize=A4)
+def render_receipt_pdf(student, fee, institute, output):
+    c = _new_canvas(output)
     width, height = A4
-    
-    logo_path = 'static/logo/logo.png'
-    if os.path.exists(logo_path):
-        try:
-            logo_width = 80
-            logo_height = 80
-            c.drawImage(logo_path, (width - logo_width) / 2, height - 90, 
-                       width=logo_width, height=logo_height, preserveAspectRatio=True, mask='auto')
-        except:
-            pass
-    
-    c.setFont("Helvetica-Bold", 20)
-    c.drawCentredString(width/2, height - 110, "SANSA LEARN")
-    
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(width/2, height - 130, institute['address'])
-    c.drawCentredString(width/2, height - 145, f"Contact: {institute['contact']}")
-    
-    c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(width/2, height - 175, "FEE DEMAND NOTICE")
+    _draw_header(c, width, height, institute, "FEE RECEIPT")
     
     y = height - 215
     c.setFont("Helvetica", 11)
-    c.drawRightString(width - 50, y, f"Date: {datetime.now().strftime('%Y-%m-%d')}")
+    
+    receipt_no = f"REC{fee['year']}{fee['month']:02d}{fee['id']:04d}"
+    c.drawString(50, y, f"Receipt No: {receipt_no}")
+    c.drawRightString(width - 50, y, f"Date: {fee['payment_date']}")
     
     y -= 30
     c.line(50, y, width - 50, y)
     y -= 25
     
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Student Details:")
-    y -= 20
-    
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Admission No: {student['admission_number']}")
-    y -= 18
-    c.drawString(70, y, f"Name: {student['name']}")
-    y -= 18
-    c.drawString(70, y, f"Father's Name: {student['father_name']}")
-    y -= 18
-    c.drawString(70, y, f"Class: {student['class']}")
+    y = _draw_student_details(c, y, student)
     
     y -= 30
     c.line(50, y, width - 50, y)
     y -= 25
     
     c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Pending Fee Details:")
-    y -= 25
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(70, y, "Month")
-    c.drawString(200, y, "Year")
-    c.drawRightString(width - 70, y, "Amount (Rs.)")
-    y -= 18
-    c.line(70, y, width - 50, y)
-    y -= 5
-    
-    c.setFont("Helvetica", 10)
-    total_pending = 0
-    for fee in unpaid_fees:
-        y -= 15
-        if y < 150:
-            c.showPage()
-            y = height - 50
-        
-        c.drawString(70, y, months[fee['month']])
-        c.drawString(200, y, str(fee['year']))
-        c.drawRightString(width - 70, y, f"{fee['fee_amount']:.2f}")
-        total_pending += fee['fee_amount']
-    
-    y -= 20
-    c.line(70, y, width - 50, y)
+    c.drawString(50, y, "Payment Details:")
     y -= 20
     
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(70, y, "Total Pending:")
-    c.drawRightString(width - 70, y, f"Rs. {total_pending:.2f}")
-    
-    y -= 40
-    c.setFont("Helvetica", 10)
-    c.drawString(50, y, "Kindly clear the above pending fees at the earliest.")
-    
-    y = 150
-    c.setFont("Helvetica", 10)
-    c.drawString(50, y, "For Sansa Learn")
+    lines = [
+        f"Fee Month: {MONTHS[fee['month']]} {fee['year']}",
+        f"Amount Paid: Rs. {fee['fee_amount']:.2f}",
+        f"Payment Mode: {fee['payment_mode']}",
+    ]
+    if fee['remarks']:
+        lines.append(f"Remarks: {fee['remarks']}")
+    y = _draw_lines(c, 70, y, lines)
     
-    signature_path = 'static/logo/signature.jpg'
-    if os.path.exists(signature_path):
-        try:
-            sig_width = 150
-            sig_height = 50
-            c.drawImage(signature_path, 50, y - 60, width=sig_width, height=sig_height)
-        except:
-            pass
+    y -= 30
+    c.line(50, y, width - 50, y)
     
-    y -= 70
-    c.drawString(50, y, "Management Signature")
+    _draw_signature_block(c)
     
     c.save()
-    
-    return send_file(filepath, as_attachment=True)
 
-@app.route('/public/demand/<admission_number>/<token>')
-def public_demand_bill(admission_number, token):
-    if not verify_pdf_token(admission_number, token):
-        return "Invalid or expired link", 403
-    
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE admission_number = %s', (admission_number,))
-    student = cursor.fetchone()
-    
-    if not student:
-        conn.close()
-        return "Student not found", 404
-    
-    cursor.execute('''
-        SELECT * FROM fees WHERE student_id = %s AND is_paid = 0 
-        ORDER BY year, month
-    ''', (student['id'],))
-    unpaid_fees = cursor.fetchall()
-    
-    cursor.execute('SELECT * FROM institute_info WHERE id = 1')
-    institute = cursor.fetchone()
-    
-    conn.close()
-    
-    filename = f"demand_{admission_number}_{datetime.now().strftime('%Y%m%d')}.pdf"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    c = canvas.Canvas(filepath, pagesize=A4)
+DEMAND_TABLE_STYLE = TableStyle([
+    ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 10),
+    ('FONT', (0, 1), (-1, -1), 'Helvetica', 10),
+    ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 0),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+    ('RIGHTPADDING', (-1, 0), (-1, -1), 20),
+    ('TOPPADDING', (0, 0), (-1, -1), 0),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
+    ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+])
+DEMAND_FOOTER_TOP = 255
+
+def render_demand_bill_pdf(student, unpaid_fees, total_pending, institute, output):
+    c = _new_canvas(output)
     width, height = A4
-    
-    logo_path = 'static/logo/logo.png'
-    if os.path.exists(logo_path):
-        try:
-            logo_width = 80
-            logo_height = 80
-            c.drawImage(logo_path, (width - logo_width) / 2, height - 90, 
-                       width=logo_width, height=logo_height, preserveAspectRatio=True, mask='auto')
-        except:
-            pass
-    
-    c.setFont("Helvetica-Bold", 20)
-    c.drawCentredString(width/2, height - 110, "SANSA LEARN")
-    
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(width/2, height - 130, institute['address'] if institute else '')
-    c.drawCentredString(width/2, height - 145, f"Contact: {institute['contact']}" if institute else '')
-    
-    c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(width/2, height - 175, "FEE DEMAND NOTICE")
+    _draw_header(c, width, height, institute, "FEE DEMAND NOTICE")
     
     y = height - 215
     c.setFont("Helvetica", 11)
@@ -1195,18 +1485,7 @@ def public_demand_bill(admission_number, token):
     c.line(50, y, width - 50, y)
     y -= 25
     
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Student Details:")
-    y -= 20
-    
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Admission No: {student['admission_number']}")
-    y -= 18
-    c.drawString(70, y, f"Name: {student['name']}")
-    y -= 18
-    c.drawString(70, y, f"Father's Name: {student['father_name']}")
-    y -= 18
-    c.drawString(70, y, f"Class: {student['class']}")
+    y = _draw_student_details(c, y, student)
     
     y -= 30
     c.line(50, y, width - 50, y)
@@ -1216,29 +1495,27 @@ def public_demand_bill(admission_number, token):
     c.drawString(50, y, "Pending Fee Details:")
     y -= 25
     
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(70, y, "Month")
-    c.drawString(200, y, "Year")
-    c.drawRightString(width - 70, y, "Amount (Rs.)")
-    y -= 18
-    c.line(70, y, width - 50, y)
-    y -= 5
-    
-    c.setFont("Helvetica", 10)
-    total_pending = 0
-    for fee in unpaid_fees:
-        y -= 15
-        if y < 150:
-            c.showPage()
-            y = height - 50
-        
-        c.drawString(70, y, months[fee['month']])
-        c.drawString(200, y, str(fee['year']))
-        c.drawRightString(width - 70, y, f"{fee['fee_amount']:.2f}")
-        total_pending += fee['fee_amount']
+    rows = [["Month", "Year", "Amount (Rs.)"]]
+    rows += [[MONTHS[fee['month']], str(fee['year']), f"{fee['fee_amount']:.2f}"] for fee in unpaid_fees]
+    
+    # Rows that don't fit are carried to the next page; the last page keeps
+    # room for the total, the note and the signature block.
+    table = Table(rows, colWidths=[130, width - 320, 120], repeatRows=1, style=DEMAND_TABLE_STYLE)
+    while True:
+        _, table_height = table.wrap(width - 120, height)
+        if y - table_height >= DEMAND_FOOTER_TOP:
+            table.drawOn(c, 70, y - table_height)
+            y -= table_height
+            break
+        parts = table.split(width - 120, y - 50)
+        if len(parts) < 2:
+            parts = table.split(width - 120, y - DEMAND_FOOTER_TOP)
+        if len(parts) == 2:
+            head, table = parts
+            _, head_height = head.wrap(width - 120, height)
+            head.drawOn(c, 70, y - head_height)
+        c.showPage()
+        y = height - 50
     
     y -= 20
     c.line(70, y, width - 50, y)
@@ -1252,179 +1529,129 @@ def public_demand_bill(admission_number, token):
     c.setFont("Helvetica", 10)
     c.drawString(50, y, "Kindly clear the above pending fees at the earliest.")
     
-    y = 150
-    c.setFont("Helvetica", 10)
-    c.drawString(50, y, "For Sansa Learn")
-    
-    signature_path = 'static/logo/signature.jpg'
-    if os.path.exists(signature_path):
-        try:
-            sig_width = 150
-            sig_height = 50
-            c.drawImage(signature_path, 50, y - 60, width=sig_width, height=sig_height)
-        except:
-            pass
-    
-    y -= 70
-    c.drawString(50, y, "Management Signature")
+    _draw_signature_block(c)
     
     c.save()
-    
-    return send_file(filepath, as_attachment=True)
 
-@app.route('/public/receipt/<admission_number>/<int:fee_id>/<token>')
-def public_receipt(admission_number, fee_id, token):
-    if not verify_pdf_token(admission_number, token):
-        return "Invalid or expired link", 403
-    
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE admission_number = %s', (admission_number,))
-    student = cursor.fetchone()
-    
-    if not student:
-        conn.close()
-        return "Student not found", 404
-    
-    cursor.execute('SELECT * FROM fees WHERE id = %s AND student_id = %s', (fee_id, student['id']))
-    fee = cursor.fetchone()
-    
-    if not fee:
-        conn.close()
-        return "Receipt not found", 404
-    
-    cursor.execute('SELECT * FROM institute_info WHERE id = 1')
-    institute = cursor.fetchone()
-    
-    conn.close()
-    
-    filename = f"receipt_{admission_number}_{fee['month']}_{fee['year']}.pdf"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    c = canvas.Canvas(filepath, pagesize=A4)
-    width, height = A4
-    
-    logo_path = 'static/logo/logo.png'
-    if os.path.exists(logo_path):
-        try:
-            logo_width = 80
-            logo_height = 80
-            c.drawImage(logo_path, (width - logo_width) / 2, height - 90, 
-                       width=logo_width, height=logo_height, preserveAspectRatio=True, mask='auto')
-        except:
-            pass
-    
-    c.setFont("Helvetica-Bold", 20)
-    c.drawCentredString(width/2, height - 110, "SANSA LEARN")
-    
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(width/2, height - 130, institute['address'] if institute else '')
-    c.drawCentredString(width/2, height - 145, f"Contact: {institute['contact']}" if institute else '')
-    
-    c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(width/2, height - 175, "FEE RECEIPT")
-    
-    y = height - 215
-    c.setFont("Helvetica", 11)
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    receipt_no = f"REC{fee['year']}{str(fee['month']).zfill(2)}{str(fee['id']).zfill(4)}"
-    c.drawString(50, y, f"Receipt No: {receipt_no}")
-    c.drawRightString(width - 50, y, f"Date: {fee['payment_date']}")
-    
-    y -= 30
-    c.line(50, y, width - 50, y)
-    y -= 25
+def receipt_pdf(student, fee):
+    institute = get_institute_info()
+    return cached_pdf('receipt', [dict(student), dict(fee), dict(institute) if institute else None],
+                      lambda output: render_receipt_pdf(student, fee, institute, output))
+
+@app.route('/student/<int:student_id>/receipt/<int:fee_id>')
+@login_required
+def generate_receipt(student_id, fee_id):
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        cursor.execute('''
+            SELECT row_to_json(s) AS student,
+                   (SELECT row_to_json(f) FROM fees f WHERE f.id = %s) AS fee
+            FROM students s WHERE s.id = %s
+        ''', (fee_id, student_id))
+        row = cursor.fetchone()
     
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Student Details:")
-    y -= 20
+    student, fee = (row['student'], row['fee']) if row else (None, None)
     
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Admission No: {student['admission_number']}")
-    y -= 18
-    c.drawString(70, y, f"Name: {student['name']}")
-    y -= 18
-    c.drawString(70, y, f"Father's Name: {student['father_name']}")
-    y -= 18
-    c.drawString(70, y, f"Class: {student['class']}")
+    if not student or not fee:
+        flash('Student or fee record not found', 'error')
+        return redirect(url_for('fee_management'))
     
-    y -= 30
-    c.line(50, y, width - 50, y)
-    y -= 25
+    pdf, etag = receipt_pdf(student, fee)
     
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(50, y, "Payment Details:")
-    y -= 20
+    return send_file(pdf, mimetype='application/pdf', as_attachment=True, etag=etag,
+                     download_name=f"receipt_{student['admission_number']}_{fee['month']}_{fee['year']}.pdf")
+
+# Student, unpaid fees and their total in one round trip, looked up by id (admin routes) or
+# by admission_number (public links). The column is never user input.
+def fetch_demand_bill(key, column='id'):
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        cursor.execute(f'''
+            SELECT row_to_json(s) AS student, u.unpaid_fees, u.total_pending
+            FROM students s CROSS JOIN LATERAL (
+                SELECT COALESCE(json_agg(f ORDER BY f.year, f.month), '[]') AS unpaid_fees,
+                       COALESCE(SUM(f.fee_amount::float8), 0) AS total_pending
+                FROM fees f WHERE f.student_id = s.id AND f.is_paid = 0
+            ) u
+            WHERE s.{column} = %s
+        ''', (key,))
+        return cursor.fetchone()
+
+def demand_bill_pdf(student, unpaid_fees, total_pending, today):
+    institute = get_institute_info()
+    return cached_pdf('demand', [today, dict(student), [dict(f) for f in unpaid_fees], dict(institute) if institute else None],
+                      lambda output: render_demand_bill_pdf(student, unpaid_fees, total_pending, institute, output))
+
+@app.route('/student/<int:student_id>/demand')
+@login_required
+def generate_demand_bill(student_id):
+    row = fetch_demand_bill(student_id)
     
-    c.setFont("Helvetica", 10)
-    c.drawString(70, y, f"Fee Month: {months[fee['month']]} {fee['year']}")
-    y -= 18
-    c.drawString(70, y, f"Amount Paid: Rs. {fee['fee_amount']:.2f}")
-    y -= 18
-    c.drawString(70, y, f"Payment Mode: {fee['payment_mode']}")
-    if fee['remarks']:
-        y -= 18
-        c.drawString(70, y, f"Remarks: {fee['remarks']}")
+    if not row:
+        flash('Student not found', 'error')
+        return redirect(url_for('fee_management'))
     
-    y -= 30
-    c.line(50, y, width - 50, y)
+    student, unpaid_fees, total_pending = row['student'], row['unpaid_fees'], row['total_pending']
+    today = datetime.now().strftime('%Y%m%d')
+    pdf, etag = demand_bill_pdf(student, unpaid_fees, total_pending, today)
     
-    y = 150
-    c.setFont("Helvetica", 10)
-    c.drawString(50, y, "For Sansa Learn")
+    return send_file(pdf, mimetype='application/pdf', as_attachment=True, etag=etag, download_name=f"demand_{student['admission_number']}_{today}.pdf")
+
+@app.route('/public/demand/<admission_number>/<token>')
+def public_demand_bill(admission_number, token):
+    if not verify_pdf_token(admission_number, token):
+        return "Invalid or expired link", 403
     
-    signature_path = 'static/logo/signature.jpg'
-    if os.path.exists(signature_path):
-        try:
-            sig_width = 150
-            sig_height = 50
-            c.drawImage(signature_path, 50, y - 60, width=sig_width, height=sig_height)
-        except:
-            pass
+    row = fetch_demand_bill(admission_number, column='admission_number')
     
-    y -= 70
-    c.drawString(50, y, "Management Signature")
+    if not row:
+        return "Student not found", 404
     
-    c.save()
+    student, unpaid_fees, total_pending = row['student'], row['unpaid_fees'], row['total_pending']
+    today = datetime.now().strftime('%Y%m%d')
+    pdf, etag = demand_bill_pdf(student, unpaid_fees, total_pending, today)
     
-    return send_file(filepath, as_attachment=True)
+    return send_file(pdf, mimetype='application/pdf', as_attachment=True, etag=etag, download_name=f"demand_{admission_number}_{today}.pdf")
 
-@app.route('/public/profile/<admission_number>/<token>')
-def public_student_profile(admission_number, token):
+@app.route('/public/receipt/<admission_number>/<int:fee_id>/<token>')
+def public_receipt(admission_number, fee_id, token):
     if not verify_pdf_token(admission_number, token):
         return "Invalid or expired link", 403
     
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT * FROM students WHERE admission_number = %s', (admission_number,))
-    student = cursor.fetchone()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        cursor.execute('''
+            SELECT row_to_json(s) AS student,
+                   (SELECT row_to_json(f) FROM fees f WHERE f.id = %s AND f.student_id = s.id) AS fee
+            FROM students s WHERE s.admission_number = %s
+        ''', (fee_id, admission_number))
+        row = cursor.fetchone()
     
-    if not student:
-        conn.close()
+    if not row:
         return "Student not found", 404
+    if not row['fee']:
+        return "Receipt not found", 404
     
-    cursor.execute('SELECT * FROM institute_info WHERE id = 1')
-    institute = cursor.fetchone()
-    
-    conn.close()
+    student, fee = row['student'], row['fee']
     
-    filename = f"profile_{admission_number}.pdf"
-    filepath = os.path.join(PDF_FOLDER, filename)
+    pdf, etag = receipt_pdf(student, fee)
     
-    c = canvas.Canvas(filepath, pagesize=A4)
+    return send_file(pdf, mimetype='application/pdf', as_attachment=True, etag=etag,
+                     download_name=f"receipt_{admission_number}_{fee['month']}_{fee['year']}.pdf")
+
+def render_student_profile_pdf(student, institute, generated_on, output):
+    c = _new_canvas(output)
     width, height = A4
     
-    logo_path = 'static/logo/logo.png'
-    if os.path.exists(logo_path):
+    logo = branding_image(LOGO_PATH)
+    if logo:
         try:
             logo_width = 70
             logo_height = 70
-            c.drawImage(logo_path, 50, height - 80, 
+            c.drawImage(logo, 50, height - 80, 
                        width=logo_width, height=logo_height, preserveAspectRatio=True, mask='auto')
         except:
             pass
@@ -1490,13 +1717,7 @@ def public_student_profile(admission_number, token):
         ("Gender:", student['gender'] or 'N/A'),
     ]
     
-    c.setFont("Helvetica", 10)
-    for label, value in details:
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(label_x, y, label)
-        c.setFont("Helvetica", 10)
-        c.drawString(value_x, y, str(value))
-        y -= 18
+    y = _draw_label_rows(c, label_x, value_x, y, details)
     
     y -= 15
     c.setFont("Helvetica-Bold", 11)
@@ -1513,13 +1734,9 @@ def public_student_profile(admission_number, token):
         ("Admission Date:", student['admission_date'] or 'N/A'),
     ]
     
-    for label, value in academic_details:
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(label_x, y, label)
-        c.setFont("Helvetica", 10)
-        display_value = str(value)[:40] + "..." if len(str(value)) > 40 else str(value)
-        c.drawString(value_x, y, display_value)
-        y -= 18
+    academic_details = [(label, str(value)[:40] + "..." if len(str(value)) > 40 else value)
+                        for label, value in academic_details]
+    y = _draw_label_rows(c, label_x, value_x, y, academic_details)
     
     y -= 15
     c.setFont("Helvetica-Bold", 11)
@@ -1565,12 +1782,7 @@ def public_student_profile(admission_number, token):
         ("Net Fee:", f"Rs. {net_fee:.2f}"),
     ]
     
-    for label, value in fee_details:
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(label_x, y, label)
-        c.setFont("Helvetica", 10)
-        c.drawString(value_x, y, str(value))
-        y -= 18
+    y = _draw_label_rows(c, label_x, value_x, y, fee_details)
     
     if student['other_details']:
         y -= 10
@@ -1588,15 +1800,15 @@ def public_student_profile(admission_number, token):
     
     y -= 20
     c.setFont("Helvetica", 9)
-    c.drawString(50, y, f"Generated on: {datetime.now().strftime('%d-%m-%Y %H:%M')}")
+    c.drawString(50, y, f"Generated on: {generated_on}")
     c.drawString(50, y - 15, "For Sansa Learn")
     
-    signature_path = 'static/logo/signature.jpg'
-    if os.path.exists(signature_path):
+    signature = branding_image(SIGNATURE_PATH)
+    if signature:
         try:
             sig_width = 120
             sig_height = 40
-            c.drawImage(signature_path, width - 180, y - 45, width=sig_width, height=sig_height)
+            c.drawImage(signature, width - 180, y - 45, width=sig_width, height=sig_height)
         except:
             pass
     
@@ -1608,99 +1820,201 @@ def public_student_profile(admission_number, token):
     c.drawCentredString(width/2, y, "Welcome to SANSA LEARN Family! We wish you success in your learning journey.")
     
     c.save()
+
+# The profile prints the day it was generated, so the day is part of the key;
+# a cached copy is never served with an earlier date.
+def student_profile_pdf(student, institute):
+    photo = student['photo_path']
+    photo_mtime = os.path.getmtime(photo) if photo and os.path.exists(photo) else None
+    generated_on = datetime.now().strftime('%d-%m-%Y')
+    return cached_pdf('profile', [generated_on, dict(student), photo_mtime, dict(institute) if institute else None],
+                      lambda output: render_student_profile_pdf(student, institute, generated_on, output))
+
+def prerender_student_profile(admission_number):
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        execute_prepared(cursor, 'student_by_admission_number',
+                         f'{SELECT_STUDENT} WHERE admission_number = %s', (admission_number,))
+        student = cursor.fetchone()
     
-    return send_file(filepath, as_attachment=True)
+    institute = get_institute_info()
+    
+    if student:
+        student_profile_pdf(student, institute)
+
+@app.route('/public/profile/<admission_number>/<token>')
+def public_student_profile(admission_number, token):
+    if not verify_pdf_token(admission_number, token):
+        return "Invalid or expired link", 403
+    
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        execute_prepared(cursor, 'student_by_admission_number',
+                         f'{SELECT_STUDENT} WHERE admission_number = %s', (admission_number,))
+        student = cursor.fetchone()
+        
+        if not student:
+            return "Student not found", 404
+    
+    institute = get_institute_info()
+    
+    pdf, etag = student_profile_pdf(student, institute)
+    
+    return send_file(pdf, mimetype='application/pdf', as_attachment=True, etag=etag, download_name=f"profile_{admission_number}.pdf")
+
+class _CopyCancelled(psycopg2.extensions.QueryCanceledError):
+    pass
+
+COPY_CHUNK_SIZE = 64 * 1024
+COPY_STALL_TIMEOUT = 60
+
+# COPY runs on a worker thread and hands chunks to the response generator
+# through a bounded queue. psycopg2 calls write() once per row, so rows are
+# joined into COPY_CHUNK_SIZE chunks before being queued. Every put gives up
+# once the response is closed (client gone) or the queue has not drained for
+# COPY_STALL_TIMEOUT seconds; that aborts the COPY and discards the connection
+# rather than returning it to the pool mid-COPY, and the thread exits.
+# The stream only ends normally on the None sentinel. An abandoned export ends
+# with an exception instead, so the response is cut off rather than looking
+# like a complete download.
+def stream_copy_csv(filename, query):
+    chunks = queue.Queue(maxsize=64)
+    cancelled = threading.Event()
+    
+    def put(item):
+        deadline = time.monotonic() + COPY_STALL_TIMEOUT
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    cancelled.set()
+        raise _CopyCancelled('export cancelled')
+    
+    class QueueWriter:
+        def __init__(self):
+            self.pending = []
+            self.size = 0
+        
+        def write(self, data):
+            self.pending.append(data)
+            self.size += len(data)
+            if self.size >= COPY_CHUNK_SIZE:
+                self.flush()
+        
+        def flush(self):
+            if not self.pending:
+                return
+            data = b''.join(self.pending)
+            self.pending, self.size = [], 0
+            put(data)
+    
+    def produce():
+        result = _CopyCancelled('export cancelled')
+        try:
+            writer = QueueWriter()
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", writer)
+                conn.commit()
+            writer.flush()
+            result = None
+        except _CopyCancelled:
+            pass
+        except Exception as e:
+            result = e
+        finally:
+            try:
+                put(result)
+            except _CopyCancelled:
+                # Nobody is draining the queue. Leave the marker if there is
+                # room; otherwise generate() sees `cancelled` once it runs dry.
+                try:
+                    chunks.put_nowait(result)
+                except queue.Full:
+                    pass
+    
+    def generate():
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=1)
+                except queue.Empty:
+                    if cancelled.is_set():
+                        raise _CopyCancelled('export abandoned before it finished')
+                    continue
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            cancelled.set()
+    
+    threading.Thread(target=produce, daemon=True).start()
+    response = Response(generate(), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+    # Runs even if the body was never iterated, which the generator's finally would miss.
+    response.call_on_close(cancelled.set)
+    return response
 
 @app.route('/export/students')
 @login_required
 def export_students():
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute('SELECT * FROM students')
-    students = cursor.fetchall()
-    conn.close()
-    
     filename = f"students_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            'ID', 'Admission Number', 'Name', 'Father Name', 'Mother Name',
-            'DOB', 'Gender', 'Class', 'Board', 'Medium', 'School Name',
-            'Address', 'Mobile 1', 'Mobile 2', 'Fee Per Month', 'Discount',
-            'Admission Date', 'Other Details'
-        ])
-        for student in students:
-            writer.writerow([
-                student['id'], student['admission_number'], student['name'],
-                student['father_name'], student['mother_name'], student['dob'],
-                student['gender'], student['class'], student['board'],
-                student['medium'], student['school_name'], student['address'],
-                student['mobile1'], student['mobile2'], student['fee_per_month'],
-                student['discount'], student['admission_date'], student['other_details']
-            ])
-    
-    return send_file(filepath, as_attachment=True)
+    
+    return stream_copy_csv(filename, '''
+        SELECT id AS "ID", admission_number AS "Admission Number", name AS "Name",
+               father_name AS "Father Name", NULLIF(mother_name, '') AS "Mother Name",
+               NULLIF(dob, '') AS "DOB", NULLIF(gender, '') AS "Gender", NULLIF(class, '') AS "Class",
+               NULLIF(board, '') AS "Board", NULLIF(medium, '') AS "Medium",
+               NULLIF(school_name, '') AS "School Name", NULLIF(address, '') AS "Address",
+               NULLIF(mobile1, '') AS "Mobile 1", NULLIF(mobile2, '') AS "Mobile 2",
+               fee_per_month AS "Fee Per Month", discount AS "Discount",
+               NULLIF(admission_date, '') AS "Admission Date", NULLIF(other_details, '') AS "Other Details"
+        FROM students
+    ''')
 
 @app.route('/export/fees')
 @login_required
 def export_fees():
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute('''
-        SELECT f.*, s.admission_number, s.name 
+    filename = f"fees_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    return stream_copy_csv(filename, '''
+        SELECT f.id AS "Fee ID", s.admission_number AS "Student Admission No", s.name AS "Student Name",
+               to_char(make_date(2000, f.month, 1), 'FMMonth') AS "Month", f.year AS "Year",
+               f.fee_amount AS "Fee Amount", CASE WHEN f.is_paid <> 0 THEN 'Yes' ELSE 'No' END AS "Is Paid",
+               NULLIF(f.payment_date, '') AS "Payment Date", NULLIF(f.payment_mode, '') AS "Payment Mode",
+               NULLIF(f.remarks, '') AS "Remarks"
         FROM fees f 
         JOIN students s ON f.student_id = s.id
         ORDER BY f.year DESC, f.month DESC
     ''')
-    fees = cursor.fetchall()
-    conn.close()
-    
-    filename = f"fees_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    filepath = os.path.join(PDF_FOLDER, filename)
-    
-    months = ['', 'January', 'February', 'March', 'April', 'May', 'June', 
-              'July', 'August', 'September', 'October', 'November', 'December']
-    
-    with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            'Fee ID', 'Student Admission No', 'Student Name', 'Month', 'Year',
-            'Fee Amount', 'Is Paid', 'Payment Date', 'Payment Mode', 'Remarks'
-        ])
-        for fee in fees:
-            writer.writerow([
-                fee['id'], fee['admission_number'], fee['name'],
-                months[fee['month']], fee['year'], fee['fee_amount'],
-                'Yes' if fee['is_paid'] else 'No', fee['payment_date'],
-                fee['payment_mode'], fee['remarks']
-            ])
-    
-    return send_file(filepath, as_attachment=True)
 
 @app.route('/sessions')
 @login_required
 def manage_sessions():
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('''
-        SELECT * FROM manager_sessions 
-        WHERE is_active = 1
-        ORDER BY last_seen_at DESC
-    ''')
-    active_sessions = cursor.fetchall()
-    
-    cursor.execute('''
-        SELECT * FROM manager_sessions 
-        WHERE is_active = 0
-        ORDER BY last_seen_at DESC
-        LIMIT 10
-    ''')
-    inactive_sessions = cursor.fetchall()
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        
+        cursor.execute('''
+            SELECT id, session_id, ip_address, user_agent, device_name, os, browser, is_active,
+                   to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+                   to_char(last_seen_at, 'YYYY-MM-DD HH24:MI:SS') AS last_seen_at
+            FROM (
+                (SELECT * FROM manager_sessions WHERE is_active = 1)
+                UNION ALL
+                (SELECT * FROM manager_sessions WHERE is_active = 0
+                 ORDER BY last_seen_at DESC LIMIT 10)
+            ) s
+            ORDER BY s.is_active DESC, s.last_seen_at DESC
+        ''')
+        rows = cursor.fetchall()
     
-    conn.close()
+    active_sessions = [row for row in rows if row['is_active'] == 1]
+    inactive_sessions = [row for row in rows if row['is_active'] == 0]
     
     current_session_id = session.get('session_record_id')
     
@@ -1712,33 +2026,33 @@ def manage_sessions():
 @app.route('/sessions/revoke/<int:session_id>', methods=['POST'])
 @login_required
 def revoke_session(session_id):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    cursor.execute('SELECT session_id, is_active FROM manager_sessions WHERE id = %s', (session_id,))
-    result = cursor.fetchone()
-    
-    if result:
-        target_session_id = result['session_id']
-        current_session_id = session.get('session_record_id')
+    with get_db() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
-        if result['is_active'] == 0:
-            flash('Session is already logged out.', 'info')
-        elif target_session_id == current_session_id:
-            flash('You cannot revoke your own current session.', 'warning')
-        else:
-            cursor.execute('''
-                UPDATE manager_sessions SET is_active = 0 WHERE id = %s AND is_active = 1
-            ''', (session_id,))
-            if cursor.rowcount > 0:
-                conn.commit()
-                flash('Session has been revoked successfully. That device will be logged out.', 'success')
+        cursor.execute('SELECT session_id, is_active FROM manager_sessions WHERE id = %s', (session_id,))
+        result = cursor.fetchone()
+        
+        if result:
+            target_session_id = result['session_id']
+            current_session_id = session.get('session_record_id')
+            
+            if result['is_active'] == 0:
+                flash('Session is already logged out.', 'info')
+            elif target_session_id == current_session_id:
+                flash('You cannot revoke your own current session.', 'warning')
             else:
-                flash('Could not revoke session.', 'error')
-    else:
-        flash('Session not found.', 'error')
+                cursor.execute('''
+                    UPDATE manager_sessions SET is_active = 0 WHERE id = %s AND is_active = 1
+                ''', (session_id,))
+                if cursor.rowcount > 0:
+                    conn.commit()
+                    _session_checked_at.pop(target_session_id, None)
+                    flash('Session has been revoked successfully. That device will be logged out.', 'success')
+                else:
+                    flash('Could not revoke session.', 'error')
+        else:
+            flash('Session not found.', 'error')
     
-    conn.close()
     return redirect(url_for('manage_sessions'))
 
 @app.route('/sessions/revoke-all', methods=['POST'])
@@ -1746,15 +2060,15 @@ def revoke_session(session_id):
 def revoke_all_sessions():
     current_session_id = session.get('session_record_id')
     
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE manager_sessions SET is_active = 0 
-        WHERE session_id != %s AND is_active = 1
-    ''', (current_session_id,))
-    revoked_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE manager_sessions SET is_active = 0 
+            WHERE session_id != %s AND is_active = 1
+        ''', (current_session_id,))
+        revoked_count = cursor.rowcount
+        conn.commit()
+    forget_session_checks(keep=current_session_id)
     
     flash(f'{revoked_count} session(s) have been revoked. All other devices will be logged out.', 'success')
     return redirect(url_for('manage_sessions'))
@@ -1762,15 +2076,14 @@ def revoke_all_sessions():
 @app.route('/sessions/cleanup', methods=['POST'])
 @login_required
 def cleanup_sessions():
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM manager_sessions 
-        WHERE is_active = 0 AND last_seen_at < NOW() - INTERVAL '30 days'
-    ''')
-    deleted_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM manager_sessions 
+            WHERE is_active = 0 AND last_seen_at < NOW() - INTERVAL '30 days'
+        ''')
+        deleted_count = cursor.rowcount
+        conn.commit()
     
     flash(f'{deleted_count} old session(s) have been cleaned up.', 'success')
     return redirect(url_for('manage_sessions'))
@@ -1778,98 +2091,143 @@ def cleanup_sessions():
 @app.route('/backup')
 @login_required
 def backup_page():
-    backup_files = []
+    entries = []
+    pending_backups = []
     if os.path.exists(BACKUP_FOLDER):
-        for f in os.listdir(BACKUP_FOLDER):
-            if f.endswith('.zip'):
-                filepath = os.path.join(BACKUP_FOLDER, f)
-                size = os.path.getsize(filepath)
-                modified = datetime.fromtimestamp(os.path.getmtime(filepath))
-                backup_files.append({
-                    'name': f,
-                    'size': f"{size / 1024:.1f} KB" if size < 1024*1024 else f"{size / (1024*1024):.1f} MB",
-                    'date': modified.strftime('%d-%m-%Y %H:%M')
-                })
-    backup_files.sort(key=lambda x: x['date'], reverse=True)
-    
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM students')
-    total_students = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM fees')
-    total_fees = cursor.fetchone()[0]
-    conn.close()
+        with os.scandir(BACKUP_FOLDER) as it:
+            for entry in it:
+                if entry.name.endswith('.zip'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.name))
+                elif entry.name.endswith('.zip.part'):
+                    name = entry.name[:-len('.part')]
+                    try:
+                        if time.time() - entry.stat().st_mtime > BACKUP_STALE_AGE:
+                            os.remove(entry.path)
+                            flash(f'Backup {name} did not finish and was discarded.', 'warning')
+                        else:
+                            pending_backups.append(name)
+                    except FileNotFoundError:
+                        pass
+                elif entry.name.endswith('.zip.error'):
+                    try:
+                        with open(entry.path) as f:
+                            message = f.read()
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    flash(f'Error creating backup {entry.name[:-len(".error")]}: {message}', 'error')
+    entries.sort(reverse=True)
+    
+    backup_files = []
+    for mtime, size, name in entries:
+        backup_files.append({
+            'name': name,
+            'size': f"{size / 1024:.1f} KB" if size < 1024*1024 else f"{size / (1024*1024):.1f} MB",
+            'date': datetime.fromtimestamp(mtime).strftime('%d-%m-%Y %H:%M')
+        })
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT (SELECT COUNT(*) FROM students), (SELECT COUNT(*) FROM fees)')
+        total_students, total_fees = cursor.fetchone()
     
     return render_template('backup.html', 
                           backup_files=backup_files,
+                          pending_backups=sorted(pending_backups),
                           total_students=total_students,
                           total_fees=total_fees)
 
+# Photos and logos are already-compressed JPEG/PNG, so they are stored as is;
+# only data.json is deflated.
+def add_folder_to_zip(zf, folder, arcname):
+    zf.mkdir(arcname)
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            zf.write(path, os.path.join(arcname, os.path.relpath(path, folder)), compress_type=zipfile.ZIP_STORED)
+
+BACKUP_TABLES = ('students', 'fees', 'institute_info', 'manager_sessions')
+
+# COPY sends one row_to_json() document per row; this joins them into a JSON
+# array as they arrive. The CSV quote/delimiter are control characters that
+# JSON text never contains unescaped, so COPY passes each document through as is.
+class _JsonArrayWriter:
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+    
+    def write(self, data):
+        if self.count:
+            self.f.write(b', ')
+        self.f.write(data.rstrip(b'\n'))
+        self.count += 1
+
+# data.json is streamed from the database with COPY, so no Python objects are
+# built per row and memory stays flat however many fee records there are.
+def write_backup_json(conn, f):
+    counts = {}
+    cursor = conn.cursor()
+    f.write(b'{"backup_date": %s, "backup_version": "1.0"' % json.dumps(datetime.now().isoformat()).encode())
+    for table in BACKUP_TABLES:
+        f.write(f', "{table}": ['.encode())
+        writer = _JsonArrayWriter(f)
+        cursor.copy_expert(f"""
+            COPY (SELECT row_to_json(t) FROM {table} t ORDER BY t.id)
+            TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+        """, writer)
+        f.write(b']')
+        counts[table] = writer.count
+    statistics = {'total_students': counts['students'], 'total_fees': counts['fees']}
+    f.write(b', "statistics": %s}' % json.dumps(statistics).encode())
+
+# Backups are built on their own single worker thread so the request returns
+# at once. The archive is written as <name>.zip.part and renamed when complete,
+# so the backup list and downloads only ever see finished files. A failure is
+# recorded as <name>.zip.error next to it, so whichever worker serves the backup
+# page next reports it. A .part file not written to for BACKUP_STALE_AGE seconds
+# was left by a crashed worker and is discarded when the page is listed.
+BACKUP_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+BACKUP_STALE_AGE = 15 * 60
+
+def build_backup(backup_name):
+    zip_path = os.path.join(BACKUP_FOLDER, f"{backup_name}.zip")
+    part_path = f"{zip_path}.part"
+    try:
+        with zipfile.ZipFile(part_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            with get_db() as conn, zf.open('data.json', 'w') as f:
+                write_backup_json(conn, f)
+            add_folder_to_zip(zf, UPLOAD_FOLDER, 'uploads')
+            if os.path.exists('static/logo'):
+                add_folder_to_zip(zf, 'static/logo', 'logo')
+        os.replace(part_path, zip_path)
+    except Exception as e:
+        with open(f"{zip_path}.error", 'w') as f:
+            f.write(str(e))
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
 @app.route('/backup/create', methods=['POST'])
 @login_required
 def create_backup():
     try:
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_name = f"sansa_learn_backup_{timestamp}"
-        backup_dir = os.path.join(BACKUP_FOLDER, backup_name)
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        conn = get_db()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        cursor.execute('SELECT * FROM students')
-        students = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.execute('SELECT * FROM fees')
-        fees = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.execute('SELECT * FROM institute_info')
-        institute_info = [dict(row) for row in cursor.fetchall()]
-        
-        cursor.execute('SELECT * FROM manager_sessions')
-        sessions_data = [dict(row) for row in cursor.fetchall()]
-        
-        conn.close()
-        
-        backup_data = {
-            'backup_date': datetime.now().isoformat(),
-            'backup_version': '1.0',
-            'students': students,
-            'fees': fees,
-            'institute_info': institute_info,
-            'manager_sessions': sessions_data,
-            'statistics': {
-                'total_students': len(students),
-                'total_fees': len(fees)
-            }
-        }
-        
-        json_path = os.path.join(backup_dir, 'data.json')
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, indent=2, ensure_ascii=False, default=str)
-        
-        uploads_backup_dir = os.path.join(backup_dir, 'uploads')
-        if os.path.exists(UPLOAD_FOLDER) and os.listdir(UPLOAD_FOLDER):
-            shutil.copytree(UPLOAD_FOLDER, uploads_backup_dir)
-        else:
-            os.makedirs(uploads_backup_dir, exist_ok=True)
-        
-        logo_backup_dir = os.path.join(backup_dir, 'logo')
-        if os.path.exists('static/logo'):
-            shutil.copytree('static/logo', logo_backup_dir)
-        
-        zip_path = os.path.join(BACKUP_FOLDER, f"{backup_name}.zip")
-        shutil.make_archive(os.path.join(BACKUP_FOLDER, backup_name), 'zip', backup_dir)
-        
-        shutil.rmtree(backup_dir)
+        run_in_background(build_backup, backup_name, executor=BACKUP_EXECUTOR)
         
-        flash(f'Backup created successfully! File: {backup_name}.zip', 'success')
+        flash(f'Backup started! File: {backup_name}.zip will be listed below once it is ready.', 'success')
         
     except Exception as e:
         flash(f'Error creating backup: {str(e)}', 'error')
     
     return redirect(url_for('backup_page'))
 
+# When nginx fronts the app, set BACKUP_ACCEL_REDIRECT to an internal location
+# aliased to the backups folder (e.g. /internal-backups/) and downloads are
+# handed to nginx instead of being streamed by a worker thread.
+BACKUP_ACCEL_REDIRECT = os.environ.get('BACKUP_ACCEL_REDIRECT')
+
 @app.route('/backup/download/<filename>')
 @login_required
 def download_backup(filename):
@@ -1877,10 +2235,17 @@ def download_backup(filename):
         flash('Invalid backup file.', 'error')
         return redirect(url_for('backup_page'))
     
-    filepath = os.path.join(BACKUP_FOLDER, secure_filename(filename))
-    if os.path.exists(filepath):
+    filename = secure_filename(filename)
+    filepath = os.path.join(BACKUP_FOLDER, filename)
+    try:
+        if BACKUP_ACCEL_REDIRECT:
+            os.stat(filepath)
+            response = Response(mimetype='application/zip')
+            response.headers['X-Accel-Redirect'] = f"{BACKUP_ACCEL_REDIRECT.rstrip('/')}/{quote(filename)}"
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
         return send_file(filepath, as_attachment=True)
-    else:
+    except FileNotFoundError:
         flash('Backup file not found.', 'error')
         return redirect(url_for('backup_page'))
 
@@ -1892,17 +2257,33 @@ def delete_backup(filename):
         return redirect(url_for('backup_page'))
     
     filepath = os.path.join(BACKUP_FOLDER, secure_filename(filename))
-    if os.path.exists(filepath):
+    try:
         os.remove(filepath)
         flash(f'Backup {filename} deleted successfully.', 'success')
-    else:
+    except FileNotFoundError:
         flash('Backup file not found.', 'error')
     
     return redirect(url_for('backup_page'))
 
+# The extracted folders are moved into place; shutil.move renames when source
+# and target share a filesystem and only falls back to copying across devices.
+def replace_folder(src, dst):
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    shutil.move(src, dst)
+
+RESTORE_COLUMNS = {
+    'students': STUDENT_COLUMNS,
+    'fees': ('id', 'student_id', 'month', 'year', 'fee_amount', 'is_paid',
+             'payment_date', 'payment_mode', 'remarks', 'created_at'),
+    'manager_sessions': ('id', 'session_id', 'ip_address', 'user_agent',
+                         'device_name', 'os', 'browser', 'is_active', 'created_at', 'last_seen_at'),
+}
+
 @app.route('/backup/restore', methods=['POST'])
 @login_required
 def restore_backup():
+    request.max_content_length = BACKUP_MAX_UPLOAD
     if 'backup_file' not in request.files:
         flash('No backup file uploaded.', 'error')
         return redirect(url_for('backup_page'))
@@ -1922,89 +2303,57 @@ def restore_backup():
             shutil.rmtree(temp_dir)
         os.makedirs(temp_dir)
         
-        zip_path = os.path.join(temp_dir, 'backup.zip')
-        file.save(zip_path)
-        
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        json_path = None
-        for root, dirs, files in os.walk(temp_dir):
-            if 'data.json' in files:
-                json_path = os.path.join(root, 'data.json')
-                restore_root = root
-                break
-        
-        if not json_path:
-            raise Exception('Invalid backup file: data.json not found')
-        
-        with open(json_path, 'r', encoding='utf-8') as f:
-            backup_data = json.load(f)
+        # Werkzeug has already spooled the upload to a seekable temp file, so
+        # it is read in place. data.json is parsed straight from the archive and
+        # only the uploads/ and logo/ folders next to it are extracted.
+        with zipfile.ZipFile(file.stream, 'r') as zip_ref:
+            names = zip_ref.namelist()
+            json_names = [n for n in names if n == 'data.json' or n.endswith('/data.json')]
+            if not json_names:
+                raise Exception('Invalid backup file: data.json not found')
+            json_name = min(json_names, key=lambda n: n.count('/'))
+            prefix = json_name[:-len('data.json')]
+            
+            with zip_ref.open(json_name) as f:
+                backup_data = json.load(f)
+            
+            folders = (f'{prefix}uploads/', f'{prefix}logo/')
+            zip_ref.extractall(temp_dir, members=[n for n in names if n.startswith(folders)])
+        restore_root = os.path.join(temp_dir, prefix)
         
-        conn = get_db()
-        cursor = conn.cursor()
+        with get_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM fees')
-        cursor.execute('DELETE FROM students')
-        cursor.execute('DELETE FROM manager_sessions')
+            cursor.execute('DELETE FROM fees')
+            cursor.execute('DELETE FROM students')
+            cursor.execute('DELETE FROM manager_sessions')
         
-        for student in backup_data.get('students', []):
-            cursor.execute('''
-                INSERT INTO students (id, admission_number, photo_path, name, father_name, mother_name,
-                    dob, gender, class, board, medium, school_name, address, mobile1, mobile2,
-                    fee_per_month, discount, admission_date, other_details, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                student.get('id'), student.get('admission_number'), student.get('photo_path'),
-                student.get('name'), student.get('father_name'), student.get('mother_name'),
-                student.get('dob'), student.get('gender'), student.get('class'),
-                student.get('board'), student.get('medium'), student.get('school_name'),
-                student.get('address'), student.get('mobile1'), student.get('mobile2'),
-                student.get('fee_per_month'), student.get('discount'), student.get('admission_date'),
-                student.get('other_details'), student.get('created_at')
-            ))
+            for table, columns in RESTORE_COLUMNS.items():
+                rows = [tuple(row.get(column) for column in columns) for row in backup_data.get(table, [])]
+                psycopg2.extras.execute_values(cursor, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                                               rows, page_size=1000)
         
-        for fee in backup_data.get('fees', []):
-            cursor.execute('''
-                INSERT INTO fees (id, student_id, month, year, fee_amount, is_paid,
-                    payment_date, payment_mode, remarks, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                fee.get('id'), fee.get('student_id'), fee.get('month'), fee.get('year'),
-                fee.get('fee_amount'), fee.get('is_paid'), fee.get('payment_date'),
-                fee.get('payment_mode'), fee.get('remarks'), fee.get('created_at')
-            ))
+            cursor.execute("SELECT setval('students_id_seq', COALESCE((SELECT MAX(id) FROM students), 1))")
+            cursor.execute("SELECT setval('fees_id_seq', COALESCE((SELECT MAX(id) FROM fees), 1))")
+            cursor.execute("SELECT setval('manager_sessions_id_seq', COALESCE((SELECT MAX(id) FROM manager_sessions), 1))")
         
-        for sess in backup_data.get('manager_sessions', []):
-            cursor.execute('''
-                INSERT INTO manager_sessions (id, session_id, ip_address, user_agent,
-                    device_name, os, browser, is_active, created_at, last_seen_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                sess.get('id'), sess.get('session_id'), sess.get('ip_address'),
-                sess.get('user_agent'), sess.get('device_name'), sess.get('os'),
-                sess.get('browser'), sess.get('is_active'), sess.get('created_at'),
-                sess.get('last_seen_at')
-            ))
-        
-        cursor.execute("SELECT setval('students_id_seq', COALESCE((SELECT MAX(id) FROM students), 1))")
-        cursor.execute("SELECT setval('fees_id_seq', COALESCE((SELECT MAX(id) FROM fees), 1))")
-        cursor.execute("SELECT setval('manager_sessions_id_seq', COALESCE((SELECT MAX(id) FROM manager_sessions), 1))")
+            conn.commit()
+            
+            # Every row was just replaced, so refresh planner statistics now
+            # rather than waiting for autovacuum to notice.
+            cursor.execute('ANALYZE students, fees, manager_sessions')
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        forget_session_checks()
         
         uploads_backup = os.path.join(restore_root, 'uploads')
         if os.path.exists(uploads_backup):
-            if os.path.exists(UPLOAD_FOLDER):
-                shutil.rmtree(UPLOAD_FOLDER)
-            shutil.copytree(uploads_backup, UPLOAD_FOLDER)
+            replace_folder(uploads_backup, UPLOAD_FOLDER)
         
         logo_backup = os.path.join(restore_root, 'logo')
         if os.path.exists(logo_backup):
-            if os.path.exists('static/logo'):
-                shutil.rmtree('static/logo')
-            shutil.copytree(logo_backup, 'static/logo')
+            replace_folder(logo_backup, 'static/logo')
+            branding_mtimes(refresh=True)
         
         shutil.rmtree(temp_dir)
         